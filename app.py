@@ -5,33 +5,53 @@ import ssl
 import asyncio
 import socket
 import time
+import html
+import re
+import uuid
+import hashlib
+import random
+import signal
+import threading
+from contextvars import ContextVar
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
-from typing import Optional, List, Dict, Any, Tuple
+from collections import OrderedDict
+from typing import Optional, List, Dict, Any, Tuple, Callable, Awaitable, NamedTuple
 from datetime import datetime, timedelta, date
-from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
+from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse, quote
 
+import aiohttp
+import asyncpg
 from aiohttp import web
 
-from aiogram import Bot, Dispatcher, F
+from aiogram import Bot, Dispatcher, F, BaseMiddleware
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import CommandStart, Command
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, Update
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType, DefaultKeyBuilder
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
-from sqlalchemy import text
+from sqlalchemy import text, event
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from prometheus_client import Counter, Histogram, CONTENT_TYPE_LATEST, generate_latest, REGISTRY
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
 
 from dateutil import tz
 from dotenv import load_dotenv
 
-import gspread
-from google.oauth2.service_account import Credentials as SheetsCreds
-from googleapiclient.discovery import build
-from google.oauth2.service_account import Credentials as CalCreds
+# gspread / google-auth импортируются лениво — только если интеграции настроены.
 
 
 # ============================================================
@@ -50,6 +70,10 @@ PRICE_USD = os.getenv("PRICE_USD", "99")
 PRICE_RUB = os.getenv("PRICE_RUB", "8000")
 
 AUTO_SLOTS_DAYS_AHEAD = int(os.getenv("AUTO_SLOTS_DAYS_AHEAD", "30"))
+# Месячные секции slots: сколько месяцев держать готовыми сверх горизонта генерации
+# и через сколько полных прошедших месяцев секция уезжает в slots_archive.
+SLOTS_PARTITIONS_AHEAD_MONTHS = int(os.getenv("SLOTS_PARTITIONS_AHEAD_MONTHS", "2"))
+SLOTS_ARCHIVE_AFTER_MONTHS = int(os.getenv("SLOTS_ARCHIVE_AFTER_MONTHS", "2"))
 MIN_DAYS_AHEAD = int(os.getenv("MIN_DAYS_AHEAD", "2"))
 SHOW_DAYS_AHEAD = int(os.getenv("SHOW_DAYS_AHEAD", "5"))
 SLOTS_DATE_PAGE_SIZE = int(os.getenv("SLOTS_DATE_PAGE_SIZE", "7"))
@@ -58,15 +82,92 @@ WORK_START_HOUR = int(os.getenv("WORK_START_HOUR", "13"))
 WORK_END_HOUR = int(os.getenv("WORK_END_HOUR", "17"))
 
 SKIP_AUTO_WEBHOOK = os.getenv("SKIP_AUTO_WEBHOOK", "0") in ("1", "true", "True")
+# 1 — отвечаем на /webhook сразу, апдейты обрабатываются пулом воркеров (порядок внутри чата сохраняется).
+WEBHOOK_FAST_ACK = os.getenv("WEBHOOK_FAST_ACK", "0") in ("1", "true", "True")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "16"))
+WEBHOOK_QUEUE_PER_WORKER = int(os.getenv("WEBHOOK_QUEUE_PER_WORKER", "100"))
+WEBHOOK_ENQUEUE_TIMEOUT_SEC = float(os.getenv("WEBHOOK_ENQUEUE_TIMEOUT_SEC", "2"))
+# При остановке: сколько ждать, пока воркеры разберут уже принятые (ack 200) апдейты.
+WEBHOOK_DRAIN_TIMEOUT_SEC = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT_SEC", "8"))
+# Сколько /webhook ждёт готовности БД на холодном старте, прежде чем ответить 503.
+WEBHOOK_READY_TIMEOUT_SEC = float(os.getenv("WEBHOOK_READY_TIMEOUT_SEC", "20"))
+# Свой Bot API сервер (local bot API или stub из bench/loadtest.py); пусто — api.telegram.org.
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "")
 
 GSPREAD_SA_JSON = os.getenv("GSPREAD_SERVICE_ACCOUNT_JSON", "")
 GSPREAD_SHEET_ID = os.getenv("GSPREAD_SHEET_ID", "")
 
 GCAL_SA_JSON = os.getenv("GCAL_SERVICE_ACCOUNT_JSON", "")
 GCAL_CALENDAR_ID = os.getenv("GCAL_CALENDAR_ID", "")
-
+# Переопределяются для прогона против локального stub-сервера.
+GCAL_API_BASE = os.getenv("GCAL_API_BASE", "https://www.googleapis.com/calendar/v3")
+GCAL_TOKEN_URI = os.getenv("GCAL_TOKEN_URI", "")
+GCAL_HTTP_POOL = int(os.getenv("GCAL_HTTP_POOL", "10"))
+GCAL_HTTP_TIMEOUT_SEC = float(os.getenv("GCAL_HTTP_TIMEOUT_SEC", "15"))
+GCAL_TOKEN_REFRESH_SKEW_SEC = int(os.getenv("GCAL_TOKEN_REFRESH_SKEW_SEC", "300"))
+
+# Пул БД. Пинг делается только для соединения, пролежавшего в пуле дольше DB_IDLE_PING_SEC.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT_SEC = float(os.getenv("DB_POOL_TIMEOUT_SEC", "10"))
+DB_POOL_RECYCLE_SEC = int(os.getenv("DB_POOL_RECYCLE_SEC", "1800"))
+DB_IDLE_PING_SEC = float(os.getenv("DB_IDLE_PING_SEC", "60"))
+# Имя экземпляра в application_name: по нему реплика узнаёт свои NOTIFY о доступности.
+INSTANCE_ID = os.getenv("INSTANCE_ID") or os.getenv("RAILWAY_REPLICA_ID") or f"{socket.gethostname()}-{os.getpid()}"
+DB_APPLICATION_NAME = f"consult-bot/{INSTANCE_ID}"[:63]
+# 1 — слушать канал slots_availability и править кеши по чужим броням и правкам слотов.
+AVAILABILITY_LISTEN = os.getenv("AVAILABILITY_LISTEN", "1") in ("1", "true", "True")
+# 0 — выключить кэш prepared statements (нужно за PgBouncer в transaction mode).
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+
+# Stale-while-revalidate: после *_TTL_SEC значение ещё отдаётся, а обновление идёт в фоне;
+# после *_HARD_TTL_SEC запись выбрасывается и читатель ждёт запрос. HARD = TTL — выключить SWR.
 DATES_CACHE_TTL_SEC = int(os.getenv("DATES_CACHE_TTL_SEC", "60"))
+DATES_CACHE_HARD_TTL_SEC = int(os.getenv("DATES_CACHE_HARD_TTL_SEC", "600"))
 TIMES_CACHE_TTL_SEC = int(os.getenv("TIMES_CACHE_TTL_SEC", "30"))
+TIMES_CACHE_HARD_TTL_SEC = int(os.getenv("TIMES_CACHE_HARD_TTL_SEC", "300"))
+TIMES_CACHE_MAX = int(os.getenv("TIMES_CACHE_MAX", "64"))
+CACHE_SWEEP_SEC = int(os.getenv("CACHE_SWEEP_SEC", "60"))
+# Период сверки slot_availability_daily со slots (с автоисправлением).
+ROLLUP_CHECK_SEC = int(os.getenv("ROLLUP_CHECK_SEC", "900"))
+# Предел на один запрос доступности; ошибку по таймауту получают все, кто ждал этот ключ.
+AVAILABILITY_QUERY_TIMEOUT_SEC = float(os.getenv("AVAILABILITY_QUERY_TIMEOUT_SEC", "5"))
+# db — пикеры читают slots/rollup на промахе кэша; memory — из индекса свободных слотов в памяти
+# (БД остаётся арбитром только при брони). Индекс перечитывается раз в AVAILABILITY_INDEX_RELOAD_SEC.
+AVAILABILITY_ENGINE = os.getenv("AVAILABILITY_ENGINE", "db").strip().lower()
+AVAILABILITY_INDEX_RELOAD_SEC = int(os.getenv("AVAILABILITY_INDEX_RELOAD_SEC", "300"))
+
+SHEETS_EXECUTOR_WORKERS = int(os.getenv("SHEETS_EXECUTOR_WORKERS", "2"))
+SHEETS_EXECUTOR_QUEUE = int(os.getenv("SHEETS_EXECUTOR_QUEUE", "4"))
+SHEETS_EXECUTOR_TIMEOUT_SEC = float(os.getenv("SHEETS_EXECUTOR_TIMEOUT_SEC", "30"))
+
+SHEETS_BATCH_MAX_ROWS = int(os.getenv("SHEETS_BATCH_MAX_ROWS", "50"))
+SHEETS_FLUSH_MS = int(os.getenv("SHEETS_FLUSH_MS", "500"))
+SHEETS_QUEUE_MAX = int(os.getenv("SHEETS_QUEUE_MAX", "1000"))
+SHEETS_MAX_RETRIES = int(os.getenv("SHEETS_MAX_RETRIES", "5"))
+
+# Лимиты Bot API: ~30 сообщений/с на бота и ~1/с в один чат (короткие всплески допустимы).
+NOTIFY_GLOBAL_RATE = float(os.getenv("NOTIFY_GLOBAL_RATE", "25"))
+NOTIFY_PER_CHAT_RATE = float(os.getenv("NOTIFY_PER_CHAT_RATE", "1"))
+NOTIFY_PER_CHAT_BURST = int(os.getenv("NOTIFY_PER_CHAT_BURST", "3"))
+# 0 — дайджест выключен; иначе сверх NOTIFY_DIGEST_BURST событий за окно копятся в одну сводку.
+NOTIFY_DIGEST_SEC = int(os.getenv("NOTIFY_DIGEST_SEC", "0"))
+NOTIFY_DIGEST_BURST = int(os.getenv("NOTIFY_DIGEST_BURST", "3"))
+
+FSM_TTL_SEC = int(os.getenv("FSM_TTL_SEC", str(3 * 24 * 3600)))
+FSM_SWEEP_SEC = int(os.getenv("FSM_SWEEP_SEC", "900"))
+
+KNOWN_USERS_MAX = int(os.getenv("KNOWN_USERS_MAX", "100000"))
+USERS_FLUSH_SEC = float(os.getenv("USERS_FLUSH_SEC", "2"))
+USERS_FLUSH_BATCH = int(os.getenv("USERS_FLUSH_BATCH", "500"))
+
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "2"))
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "10"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_POLL_SEC = float(os.getenv("OUTBOX_POLL_SEC", "5"))
+OUTBOX_LEASE_SEC = int(os.getenv("OUTBOX_LEASE_SEC", "120"))
+OUTBOX_BACKOFF_BASE_SEC = float(os.getenv("OUTBOX_BACKOFF_BASE_SEC", "5"))
+OUTBOX_BACKOFF_MAX_SEC = float(os.getenv("OUTBOX_BACKOFF_MAX_SEC", "900"))
 
 
 def mask_token(t: str, keep: int = 8) -> str:
@@ -95,6 +196,10 @@ print("GSPREAD_SHEET_ID set:", bool(GSPREAD_SHEET_ID))
 print("GCAL enabled:", bool(GCAL_SA_JSON))
 print("GCAL_CALENDAR_ID:", GCAL_CALENDAR_ID or "EMPTY")
 print("SKIP_AUTO_WEBHOOK:", SKIP_AUTO_WEBHOOK)
+print("WEBHOOK_FAST_ACK:", WEBHOOK_FAST_ACK)
+print("TELEGRAM_API_BASE:", TELEGRAM_API_BASE or "default")
+print("DB application_name:", DB_APPLICATION_NAME)
+print("AVAILABILITY_ENGINE:", AVAILABILITY_ENGINE)
 print("TZ:", TZ_NAME)
 print("MIN_DAYS_AHEAD:", MIN_DAYS_AHEAD, "SHOW_DAYS_AHEAD:", SHOW_DAYS_AHEAD)
 print("AUTO_SLOTS_DAYS_AHEAD:", AUTO_SLOTS_DAYS_AHEAD)
@@ -106,6 +211,142 @@ if not DATABASE_URL_ENV:
     raise RuntimeError("DATABASE_URL отсутствует.")
 
 
+# ============================================================
+# Metrics (Prometheus, GET /metrics)
+# ============================================================
+HANDLER_LATENCY = Histogram("bot_handler_seconds", "Aiogram handler latency", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Aiogram handler exceptions", ["handler"])
+SQL_LATENCY = Histogram(
+    "db_query_seconds", "SQL statement latency", ["statement"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+POOL_CHECKOUT_WAIT = Histogram(
+    "db_pool_checkout_seconds", "Time to get a connection from the SQLAlchemy pool",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+POOL_STALE = Counter("db_pool_stale_total", "Idle pooled connections found dead on checkout and replaced")
+CACHE_REQUESTS = Counter("cache_requests_total", "Availability cache lookups", ["cache", "result"])
+CACHE_EVICTIONS = Counter("cache_evictions_total", "Availability cache entries removed", ["cache", "reason"])
+ROLLUP_DRIFT = Counter("availability_rollup_drift_total", "Days where slot_availability_daily disagreed with slots")
+AVAILABILITY_EVENTS = Counter(
+    "availability_events_total", "slots_availability notifications received", ["op", "origin"]
+)
+SINGLEFLIGHT_CALLS = Counter(
+    "singleflight_calls_total",
+    "Availability loads by role: leader runs the query for a miss, refresh runs it in the background, joined reuses one",
+    ["key", "role"],
+)
+TG_API_LATENCY = Histogram("telegram_api_seconds", "Telegram Bot API call latency", ["method"])
+TG_API_ERRORS = Counter("telegram_api_errors_total", "Failed Telegram Bot API calls", ["method"])
+WEBHOOK_UPDATES = Counter("webhook_updates_total", "Fast-ack webhook intake by result", ["result"])
+WEBHOOK_QUEUE_WAIT = Histogram("webhook_queue_wait_seconds", "Time an update waited for its worker")
+
+_sql_labels: Dict[str, str] = {}
+
+
+def named_sql(label: str, statement: str):
+    """text() с явной меткой для db_query_seconds: у запросов с общим началом метки не склеиваются."""
+    return text(statement).execution_options(metrics_label=label)
+
+
+def _sql_label(statement: str) -> str:
+    """
+    Метка для запроса без явной: первые 72 символа без лишних пробелов плюс хеш всего текста
+    (запросы статичные, кардинальность мала, а одинаковое начало не сливает разные запросы).
+    """
+    label = _sql_labels.get(statement)
+    if label is None:
+        short = re.sub(r"\s+", " ", statement).strip()[:72]
+        digest = hashlib.sha1(statement.encode()).hexdigest()[:6]
+        label = _sql_labels[statement] = f"{short} #{digest}"
+    return label
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        h = data.get("handler")
+        name = getattr(getattr(h, "callback", None), "__name__", "unknown")
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.labels(name).inc()
+            raise
+        finally:
+            HANDLER_LATENCY.labels(name).observe(time.perf_counter() - t0)
+
+
+class TelegramApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = getattr(method, "__api_method__", type(method).__name__)
+        t0 = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            TG_API_ERRORS.labels(name).inc()
+            raise
+        finally:
+            TG_API_LATENCY.labels(name).observe(time.perf_counter() - t0)
+
+
+class RuntimeCollector:
+    """Снимает состояние пула БД и executors в момент скрейпа."""
+
+    def describe(self):
+        # Без describe() registry вызвал бы collect() при регистрации, до создания engine.
+        return []
+
+    def collect(self):
+        pool = engine.pool
+        g = GaugeMetricFamily("db_pool_connections", "SQLAlchemy pool connections", labels=["state"])
+        g.add_metric(["checked_out"], pool.checkedout())
+        g.add_metric(["checked_in"], pool.checkedin())
+        g.add_metric(["overflow"], max(pool.overflow(), 0))
+        g.add_metric(["size"], pool.size())
+        g.add_metric(["max"], pool.size() + DB_MAX_OVERFLOW)
+        yield g
+
+        active = GaugeMetricFamily("executor_active", "Running tasks", labels=["executor"])
+        queued = GaugeMetricFamily("executor_queued", "Tasks waiting for a worker", labels=["executor"])
+        done = CounterMetricFamily("executor_tasks", "Finished tasks by outcome", labels=["executor", "outcome"])
+        lat = CounterMetricFamily("executor_latency_seconds", "Total task latency", labels=["executor"])
+        for ex in EXECUTORS.values():
+            st = ex.stats()
+            active.add_metric([ex.name], st["active"])
+            queued.add_metric([ex.name], st["queued"])
+            for outcome in ("completed", "failed", "rejected", "timeouts"):
+                done.add_metric([ex.name, outcome], st[outcome])
+            lat.add_metric([ex.name], ex.latency_sum)
+        yield active
+        yield queued
+        yield done
+        yield lat
+
+        entries = GaugeMetricFamily("cache_entries", "Availability cache entries", labels=["cache"])
+        entries.add_metric(["times"], len(_times_cache))
+        yield entries
+        size = GaugeMetricFamily("cache_bytes", "Approximate availability cache memory", labels=["cache"])
+        size.add_metric(["times"], _times_cache.bytes)
+        yield size
+
+        inflight = GaugeMetricFamily("singleflight_inflight", "Availability loads currently in flight")
+        inflight.add_metric([], availability_flight.inflight())
+        yield inflight
+
+        if AVAILABILITY_ENGINE == "memory":
+            idx = GaugeMetricFamily("availability_index_slots", "Free slots held by the in-memory availability index")
+            idx.add_metric([], len(availability_index))
+            yield idx
+
+        if webhook_queue is not None:
+            depth = GaugeMetricFamily("webhook_queue_depth", "Updates waiting in fast-ack worker queues")
+            depth.add_metric([], webhook_queue.depth())
+            yield depth
+
+
+REGISTRY.register(RuntimeCollector())
+
+
 # ============================================================
 # DB URL normalize
 # ============================================================
@@ -124,80 +365,350 @@ def normalize_database_url(raw: str) -> str:
     return urlunparse((u.scheme, u.netloc, u.path, u.params, urlencode(q), u.fragment))
 
 
-def debug_db_dns(url: str):
+async def debug_db_dns(url: str):
     p = urlparse(url)
     host, port = p.hostname, p.port
     print(f"[DB DEBUG] URL={url}")
     print(f"[DB DEBUG] HOST={host} PORT={port}")
+    if not host:
+        return
     try:
-        ip = socket.gethostbyname(host)
-        print(f"[DB DEBUG] DNS OK -> {host} -> {ip}")
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port or 5432, type=socket.SOCK_STREAM)
+        print(f"[DB DEBUG] DNS OK -> {host} -> {infos[0][4][0]}")
     except Exception as e:
         print(f"[DB DEBUG] DNS FAIL for {host}: {repr(e)}")
 
 
 DATABASE_URL = normalize_database_url(DATABASE_URL_ENV)
-debug_db_dns(DATABASE_URL)
 
 
 # ============================================================
 # Aiogram & DB
 # ============================================================
-bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
+bot_session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_BASE)) if TELEGRAM_API_BASE else AiohttpSession()
+bot = Bot(BOT_TOKEN, session=bot_session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+bot.session.middleware(TelegramApiMetricsMiddleware())
 
 SSL_CTX = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
 SSL_CTX.check_hostname = False
 SSL_CTX.verify_mode = ssl.CERT_NONE
 
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Пул, замеряющий ожидание checkout (включая открытие нового соединения)."""
+
+    def _do_get(self):
+        t0 = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_CHECKOUT_WAIT.observe(time.perf_counter() - t0)
+
+
 engine = create_async_engine(
     DATABASE_URL,
     echo=False,
     future=True,
-    pool_pre_ping=True,
-    connect_args={"ssl": SSL_CTX},
+    poolclass=TimedQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT_SEC,
+    pool_recycle=DB_POOL_RECYCLE_SEC,
+    pool_use_lifo=True,  # горячие соединения переиспользуются, лишние дольше простаивают и уходят по recycle
+    connect_args={
+        "ssl": SSL_CTX,
+        "prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE,
+        "server_settings": {"application_name": DB_APPLICATION_NAME},
+    },
 )
 Session = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
 
+@event.listens_for(engine.sync_engine, "checkin")
+def _pool_checkin(dbapi_conn, record):
+    record.info["checkin_at"] = time.monotonic()
+
+
+@event.listens_for(engine.sync_engine, "checkout")
+def _pool_checkout(dbapi_conn, record, proxy):
+    """Вместо pool_pre_ping на каждый checkout: пингуем только долго простоявшее соединение."""
+    idle = time.monotonic() - record.info.get("checkin_at", time.monotonic())
+    if idle < DB_IDLE_PING_SEC:
+        return
+    try:
+        dbapi_conn.ping()
+    except Exception as e:
+        POOL_STALE.inc()
+        # пул закроет это соединение и повторит checkout с новым
+        raise DisconnectionError(f"idle connection is dead: {e!r}") from e
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _sql_timer_start(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_t0 = time.perf_counter()
+
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def _sql_timer_stop(conn, cursor, statement, parameters, context, executemany):
+    t0 = getattr(context, "_metrics_t0", None)
+    if t0 is not None:
+        label = context.execution_options.get("metrics_label") or _sql_label(statement)
+        SQL_LATENCY.labels(label).observe(time.perf_counter() - t0)
+
+
 async def _db_self_test():
     async with engine.connect() as conn:
         await conn.execute(text("SELECT 1"))
     print("DB SELF-TEST: OK")
 
 
-SCHEMA_STMTS = [
+# ============================================================
+# Migrations
+# ============================================================
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+MIGRATIONS_LOCK_ID = 0x6D6E6F67  # ключ pg_advisory_xact_lock: одновременно мигрирует одна реплика
+_MIGRATION_FILE_RE = re.compile(r"^(\d+)_([\w-]+)\.sql$")
+
+SCHEMA_MIGRATIONS_DDL = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+  version INTEGER PRIMARY KEY,
+  name TEXT NOT NULL,
+  checksum TEXT NOT NULL,
+  applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+)
+"""
+
+
+def load_migrations() -> List[Tuple[int, str, str, str]]:
+    """(version, name, sql, sha256) по файлам migrations/NNN_name.sql в порядке версий."""
+    out = []
+    for fname in os.listdir(MIGRATIONS_DIR):
+        m = _MIGRATION_FILE_RE.match(fname)
+        if not m:
+            continue
+        with open(os.path.join(MIGRATIONS_DIR, fname), "rb") as f:
+            raw = f.read()
+        out.append((int(m.group(1)), m.group(2), raw.decode("utf-8"), hashlib.sha256(raw).hexdigest()))
+    out.sort()
+    versions = [v for v, *_ in out]
+    if len(versions) != len(set(versions)):
+        raise RuntimeError(f"duplicate migration versions in {MIGRATIONS_DIR}")
+    return out
+
+
+async def _applied_migrations(conn) -> Dict[int, str]:
+    if not await conn.fetchval("SELECT to_regclass('schema_migrations') IS NOT NULL"):
+        return {}
+    return {r["version"]: r["checksum"] for r in await conn.fetch("SELECT version, checksum FROM schema_migrations")}
+
+
+async def run_migrations():
     """
-    CREATE TABLE IF NOT EXISTS users (
-      id SERIAL PRIMARY KEY,
-      tg_id BIGINT UNIQUE NOT NULL,
-      username TEXT
-    )
-    """,
+    Применяет недостающие миграции одной транзакцией под advisory-lock.
+    Если всё уже применено — один SELECT и выход: рестарт реплик не трогает DDL и не берёт блокировок.
     """
-    CREATE TABLE IF NOT EXISTS slots (
-      id SERIAL PRIMARY KEY,
-      start_utc TIMESTAMPTZ NOT NULL,
-      end_utc   TIMESTAMPTZ NOT NULL,
-      is_booked BOOLEAN NOT NULL DEFAULT false
-    )
-    """,
+    migrations = load_migrations()
+    done_now = 0
+    async with engine.connect() as sa_conn:
+        # мульти-statement SQL идёт через simple query protocol asyncpg, мимо text()
+        conn = (await sa_conn.get_raw_connection()).driver_connection
+        applied = await _applied_migrations(conn)
+        pending = [m for m in migrations if m[0] not in applied]
+        if pending:
+            async with conn.transaction():
+                await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATIONS_LOCK_ID)
+                await conn.execute(SCHEMA_MIGRATIONS_DDL)
+                # пока ждали lock, соседняя реплика могла всё применить
+                applied = await _applied_migrations(conn)
+                for version, name, sql, checksum in migrations:
+                    if version in applied:
+                        continue
+                    t0 = time.perf_counter()
+                    await conn.execute(sql)
+                    await conn.execute(
+                        "INSERT INTO schema_migrations(version, name, checksum) VALUES ($1, $2, $3)",
+                        version, name, checksum,
+                    )
+                    applied[version] = checksum
+                    done_now += 1
+                    print(f"MIGRATION {version:03d}_{name}: applied in {(time.perf_counter() - t0) * 1000:.0f} ms")
+
+    for version, name, _, checksum in migrations:
+        if applied.get(version, checksum) != checksum:
+            print(f"WARN: migration {version:03d}_{name} changed after it was applied (checksum mismatch)")
+    print(f"DB MIGRATIONS: OK (version {max(applied, default=0)}, applied now: {done_now})")
+
+
+# ============================================================
+# FSM storage (Postgres, общий для реплик)
+# ============================================================
+FSM_SELECT_SQL = named_sql("fsm_select",
     """
-    CREATE UNIQUE INDEX IF NOT EXISTS idx_slots_start_utc_unique
-    ON slots(start_utc)
-    """,
+    SELECT state, data FROM fsm_state
+    WHERE key = :k AND updated_at > now() - make_interval(secs => CAST(:ttl AS int))
     """
-    CREATE INDEX IF NOT EXISTS idx_slots_is_booked_start
-    ON slots(is_booked, start_utc)
-    """,
-]
+)
+
+FSM_UPSERT_SQL = named_sql("fsm_upsert",
+    """
+    INSERT INTO fsm_state(key, state, data, updated_at)
+    SELECT k, st, CAST(d AS jsonb), now()
+    FROM unnest(CAST(:keys AS text[]), CAST(:states AS text[]), CAST(:datas AS text[])) AS t(k, st, d)
+    ON CONFLICT (key) DO UPDATE
+    SET state = EXCLUDED.state, data = EXCLUDED.data, updated_at = EXCLUDED.updated_at
+    """
+)
+
+
+# Шаг FSM = обработка одного апдейта: key -> (state, data, изменено в шаге).
+_fsm_step: ContextVar[Optional[Dict[str, Tuple[Optional[str], Dict[str, Any], bool]]]] = ContextVar(
+    "fsm_step", default=None
+)
+
+
+class PgStorage(BaseStorage):
+    """
+    FSM-хранилище в таблице fsm_state, общее для всех реплик: следующий апдейт чата может
+    прийти на другую. Поэтому между апдейтами ничего не кешируется — снимок читается из БД
+    один раз за шаг (FsmStepMiddleware), а запись сквозная: изменения одного шага
+    (update_data + set_state) уходят одним upsert до того, как апдейт считается обработанным.
+    Вне шага каждая запись идёт в БД сразу. Анкеты, не менявшиеся дольше FSM_TTL_SEC, удаляются.
+    """
+
+    def __init__(self, ttl_sec: int):
+        self.ttl_sec = ttl_sec
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+        self._sweep_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._sweep_task is None:
+            self._sweep_task = asyncio.create_task(self._sweep_loop())
+
+    async def _load(self, k: str) -> Tuple[Optional[str], Dict[str, Any]]:
+        step = _fsm_step.get()
+        if step is not None and k in step:
+            st, data, _ = step[k]
+            return st, data
+        async with Session() as s:
+            row = (await s.execute(FSM_SELECT_SQL, {"k": k, "ttl": self.ttl_sec})).first()
+        st, data = (None, {}) if row is None else (row[0], row[1])
+        if isinstance(data, str):
+            data = json.loads(data)
+        if step is not None:
+            step[k] = (st, data, False)
+        return st, data
+
+    async def _write(self, k: str, st: Optional[str], data: Dict[str, Any]):
+        step = _fsm_step.get()
+        if step is not None:
+            step[k] = (st, data, True)
+            return
+        await self._persist({k: (st, data)})
+
+    async def flush_step(self):
+        """Изменения текущего шага — в БД; шаг продолжается с чистыми записями."""
+        step = _fsm_step.get()
+        if not step:
+            return
+        batch = {k: (st, data) for k, (st, data, changed) in step.items() if changed}
+        if batch:
+            await self._persist(batch)
+            for k, (st, data) in batch.items():
+                step[k] = (st, data, False)
+
+    async def _persist(self, batch: Dict[str, Tuple[Optional[str], Dict[str, Any]]]):
+        upsert = {k: v for k, v in batch.items() if v[0] is not None or v[1]}
+        delete = [k for k in batch if k not in upsert]
+        async with Session() as s:
+            if upsert:
+                await s.execute(FSM_UPSERT_SQL, {
+                    "keys": list(upsert),
+                    "states": [st for st, _ in upsert.values()],
+                    "datas": [json.dumps(d, ensure_ascii=False, default=str) for _, d in upsert.values()],
+                })
+            if delete:
+                await s.execute(text("DELETE FROM fsm_state WHERE key = ANY(CAST(:keys AS text[]))"), {"keys": delete})
+            await s.commit()
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(FSM_SWEEP_SEC)
+            try:
+                async with Session() as s:
+                    res = await s.execute(
+                        text("DELETE FROM fsm_state WHERE updated_at < now() - make_interval(secs => CAST(:ttl AS int))"),
+                        {"ttl": self.ttl_sec},
+                    )
+                    await s.commit()
+                if res.rowcount:
+                    print(f"FSM: expired {res.rowcount} idle form(s)")
+            except Exception as e:
+                print("FSM sweep warn:", repr(e))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = self.key_builder.build(key)
+        _, data = await self._load(k)
+        await self._write(k, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        st, _ = await self._load(self.key_builder.build(key))
+        return st
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        k = self.key_builder.build(key)
+        st, _ = await self._load(k)
+        await self._write(k, st, dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(self.key_builder.build(key))
+        return dict(data)
+
+    async def close(self) -> None:
+        if self._sweep_task is not None:
+            self._sweep_task.cancel()
+
+
+class FsmStepMiddleware(BaseMiddleware):
+    """Шаг FSM на апдейт: чтения кешируются в пределах шага, записи уходят одним upsert в его конце."""
+
+    def __init__(self, storage: PgStorage):
+        self.storage = storage
+
+    async def __call__(self, handler, event, data):
+        token = _fsm_step.set({})
+        try:
+            return await handler(event, data)
+        finally:
+            # и при ошибке хендлера: сделанное до неё записано, как было бы без слияния
+            try:
+                await self.storage.flush_step()
+            finally:
+                _fsm_step.reset(token)
+
 
+class FsmFlushRequestMiddleware(BaseRequestMiddleware):
+    """
+    Перед вызовом Bot API из шага его изменения уже в БД: ответив на сообщение, пользователь
+    может прислать следующее раньше конца шага, и оно (на любой реплике) должно увидеть новый state.
+    """
 
-async def _db_init_schema():
-    async with engine.begin() as conn:
-        for stmt in SCHEMA_STMTS:
-            await conn.execute(text(stmt))
-    print("DB INIT: OK")
+    def __init__(self, storage: PgStorage):
+        self.storage = storage
+
+    async def __call__(self, make_request, bot, method):
+        await self.storage.flush_step()
+        return await make_request(bot, method)
+
+
+fsm_storage = PgStorage(FSM_TTL_SEC)
+dp = Dispatcher(storage=fsm_storage)
+# Шаг снаружи FSMContextMiddleware (его регистрирует Dispatcher): её get_state тоже попадает в шаг.
+dp.update.outer_middleware.unregister(dp.fsm)
+dp.update.outer_middleware(FsmStepMiddleware(fsm_storage))
+dp.update.outer_middleware(dp.fsm)
+bot.session.middleware(FsmFlushRequestMiddleware(fsm_storage))
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
 
 
 # ============================================================
@@ -232,24 +743,29 @@ def _cutoff_utc() -> datetime:
     return (now_local + timedelta(days=MIN_DAYS_AHEAD + SHOW_DAYS_AHEAD)).astimezone(tz.UTC)
 
 
-async def notify_admins(text_msg: str):
-    if not ADMIN_IDS:
-        return
-    for aid in ADMIN_IDS:
-        try:
-            await bot.send_message(aid, text_msg)
-        except Exception:
-            pass
+def _markup_sig(kb: Optional[InlineKeyboardMarkup]) -> Optional[str]:
+    if kb is None or not kb.inline_keyboard:
+        return None
+    return kb.model_dump_json(exclude_none=True)
 
 
-async def safe_edit(msg: Message, text_msg: str, kb: Optional[InlineKeyboardMarkup]):
+async def safe_edit(msg: Message, text_msg: str, kb: Optional[InlineKeyboardMarkup], kb_sig: Optional[str] = None):
+    """
+    Один editMessageText сразу с клавиатурой (без reply_markup Telegram её снимает)
+    и ноль вызовов, если текст и клавиатура не изменились. Сравниваем с сообщением
+    из самого колбэка — это то, что сейчас видит пользователь, какая бы реплика
+    и что бы ни отрисовало его последним.
+    """
+    current = msg.html_text if getattr(msg, "text", None) is not None else None
+    if current == text_msg and _markup_sig(getattr(msg, "reply_markup", None)) == (
+        kb_sig if kb_sig is not None else _markup_sig(kb)
+    ):
+        return
     try:
-        await msg.edit_text(text_msg)
-        await msg.edit_reply_markup(reply_markup=kb)
+        await msg.edit_text(text_msg, reply_markup=kb)
     except TelegramBadRequest as e:
-        if "message is not modified" in str(e).lower():
-            return
-        raise
+        if "message is not modified" not in str(e).lower():
+            raise
 
 
 def format_new_booking_admin_message(data: dict, tg_user_id: int, tg_username_fallback: str, gcal_event_id: str) -> str:
@@ -269,57 +785,463 @@ def format_new_booking_admin_message(data: dict, tg_user_id: int, tg_username_fa
     )
 
 
+# ============================================================
+# Уведомления админам
+# ============================================================
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = max(rate, 0.001)
+        self.capacity = max(1.0, burst)
+        self.tokens = self.capacity
+        self.ts = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        # Лок держится и во время ожидания — ждущие обслуживаются по очереди.
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.ts) * self.rate)
+                self.ts = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AdminNotifier:
+    """
+    Рассылка админам: всем чатам параллельно, под общим и per-chat token bucket,
+    с повтором после RetryAfter. В режиме дайджеста (digest_sec > 0) сообщения
+    сверх digest_burst за окно складываются в одну сводку на админа.
+    """
+
+    MAX_LEN = 4096
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int, digest_sec: int, digest_burst: int):
+        self._global = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.digest_sec = digest_sec
+        self.digest_burst = max(0, digest_burst)
+        self._chat: Dict[int, TokenBucket] = {}
+        self._window: Dict[int, Tuple[float, int]] = {}
+        self._digest: Dict[int, List[str]] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        self._pending: set = set()
+
+    async def notify(self, text_msg: str, reliable: bool = False):
+        """
+        reliable=True — для заданий outbox: мимо дайджеста в памяти и с исключением, если
+        хоть одному админу не доставлено, чтобы задание ушло на повтор (at-least-once).
+        """
+        if not ADMIN_IDS:
+            return
+        await asyncio.gather(*(self._deliver(aid, text_msg, reliable) for aid in ADMIN_IDS))
+
+    def notify_nowait(self, text_msg: str):
+        """Не задерживает пользовательский хендлер: отправка уходит в фон."""
+        if not ADMIN_IDS:
+            return
+        t = asyncio.create_task(self.notify(text_msg))
+        self._pending.add(t)
+        t.add_done_callback(self._pending.discard)
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        b = self._chat.get(chat_id)
+        if b is None:
+            b = self._chat[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return b
+
+    def _over_burst(self, chat_id: int) -> bool:
+        now = time.monotonic()
+        start, cnt = self._window.get(chat_id, (now, 0))
+        if now - start >= self.digest_sec:
+            start, cnt = now, 0
+        self._window[chat_id] = (start, cnt + 1)
+        return cnt + 1 > self.digest_burst
+
+    async def _deliver(self, chat_id: int, text_msg: str, reliable: bool = False):
+        if not reliable and self.digest_sec > 0 and self._over_burst(chat_id):
+            self._digest.setdefault(chat_id, []).append(text_msg)
+            if self._flusher is None or self._flusher.done():
+                self._flusher = asyncio.create_task(self._flush_loop())
+            return
+        await self._send(chat_id, text_msg, raise_errors=reliable)
+
+    async def _send(self, chat_id: int, text_msg: str, raise_errors: bool = False):
+        last: Optional[Exception] = None
+        for _ in range(3):
+            await self._global.acquire()
+            await self._bucket(chat_id).acquire()
+            try:
+                await bot.send_message(chat_id, text_msg)
+                return
+            except TelegramRetryAfter as e:
+                last = e
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                print(f"WARN: notify admin {chat_id} failed:", repr(e))
+                if raise_errors:
+                    raise
+                return
+        print(f"WARN: notify admin {chat_id} gave up after RetryAfter")
+        if raise_errors:
+            raise last
+
+    def _digest_messages(self, items: List[str]) -> List[str]:
+        if len(items) == 1:
+            return items
+        head = f"📬 <b>Сводка событий: {len(items)}</b>\n\n"
+        sep = "\n\n———\n\n"
+        out, cur = [], head
+        for it in items:
+            if cur != head and len(cur) + len(sep) + len(it) > self.MAX_LEN:
+                out.append(cur)
+                cur = head
+            cur = cur + (sep if cur != head else "") + it
+        out.append(cur)
+        return out
+
+    async def _flush_loop(self):
+        while self._digest:
+            await asyncio.sleep(self.digest_sec)
+            batches, self._digest = self._digest, {}
+            await asyncio.gather(*(
+                self._send(chat_id, msg)
+                for chat_id, items in batches.items()
+                for msg in self._digest_messages(items)
+            ))
+
+
+admin_notifier = AdminNotifier(
+    NOTIFY_GLOBAL_RATE, NOTIFY_PER_CHAT_RATE, NOTIFY_PER_CHAT_BURST, NOTIFY_DIGEST_SEC, NOTIFY_DIGEST_BURST
+)
+
+
+async def notify_admins(text_msg: str):
+    await admin_notifier.notify(text_msg)
+
+
+# ============================================================
+# Executors для блокирующих интеграций
+# ============================================================
+class ExecutorOverloaded(RuntimeError):
+    pass
+
+
+class BoundedExecutor:
+    """
+    Именованный пул потоков с лимитом очереди и таймаутом. Лишние задачи
+    отклоняются сразу (ExecutorOverloaded), а не копятся: деградировавшая
+    интеграция не забирает потоки у остальных, в т.ч. у default executor.
+    Поток, переживший таймаут, продолжает числиться активным до завершения.
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queue: int, timeout_sec: float):
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self.timeout_sec = timeout_sec
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=f"ex-{name}")
+        self._lock = threading.Lock()
+        self.active = 0
+        self.queued = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+
+    async def run(self, fn: Callable[[], Any], timeout: Optional[float] = None) -> Any:
+        with self._lock:
+            if self.active + self.queued >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise ExecutorOverloaded(f"executor {self.name} overloaded ({self.active} active, {self.queued} queued)")
+            self.queued += 1
+
+        def call():
+            with self._lock:
+                self.queued -= 1
+                self.active += 1
+            try:
+                return fn()
+            finally:
+                with self._lock:
+                    self.active -= 1
+
+        t0 = time.perf_counter()
+        cf = self._pool.submit(call)
+        try:
+            res = await asyncio.wait_for(asyncio.wrap_future(cf), timeout or self.timeout_sec)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+                if cf.cancel():
+                    self.queued -= 1
+            raise
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            dt = time.perf_counter() - t0
+            with self._lock:
+                self.latency_sum += dt
+                self.latency_max = max(self.latency_max, dt)
+        with self._lock:
+            self.completed += 1
+        return res
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            done = self.completed + self.failed + self.timeouts
+            return {
+                "name": self.name,
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "active": self.active,
+                "queued": self.queued,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+                "avg_latency_ms": round(self.latency_sum / done * 1000, 1) if done else 0.0,
+                "max_latency_ms": round(self.latency_max * 1000, 1),
+            }
+
+
+EXECUTORS: Dict[str, BoundedExecutor] = {}
+
+
+def _register_executor(ex: BoundedExecutor) -> BoundedExecutor:
+    EXECUTORS[ex.name] = ex
+    return ex
+
+
+sheets_executor = _register_executor(
+    BoundedExecutor("sheets", SHEETS_EXECUTOR_WORKERS, SHEETS_EXECUTOR_QUEUE, SHEETS_EXECUTOR_TIMEOUT_SEC)
+)
+
+
 # ============================================================
 # Slots generator
 # ============================================================
-def _localize(dt_naive: datetime) -> datetime:
-    return dt_naive.replace(tzinfo=_tzinfo())
+def _slots_watermark_key() -> str:
+    """Водяной знак привязан к сетке слотов: смена TZ/часов/длительности начинает генерацию заново."""
+    return f"{TZ_NAME}:{WORK_START_HOUR}-{WORK_END_HOUR}:{SLOT_MINUTES}"
 
 
-def _to_utc(dt_local: datetime) -> datetime:
-    return dt_local.astimezone(tz.UTC)
+# Одна set-based вставка за прогон: дни берутся от водяного знака (или от сегодня) до last,
+# часы — WORK_START_HOUR..WORK_END_HOUR, выходные отбрасываются. Водяной знак
+# продвигается в том же запросе, так что следующий прогон материализует только новые дни.
+ENSURE_SLOTS_SQL = named_sql("ensure_slots",
+    """
+    WITH wm AS (
+        SELECT CASE
+            WHEN CAST(:force AS boolean) THEN CAST(:today AS date)
+            ELSE GREATEST(
+                CAST(:today AS date),
+                COALESCE(
+                    (SELECT generated_until + 1 FROM slots_watermark WHERE key = :key),
+                    CAST(:today AS date)
+                )
+            )
+        END AS from_date
+    ),
+    grid AS (
+        SELECT wm.from_date + g.i + make_time(h.hour, 0, 0) AS start_local
+        FROM wm
+        CROSS JOIN LATERAL generate_series(0, CAST(:last AS date) - wm.from_date) AS g(i)
+        CROSS JOIN generate_series(CAST(:h0 AS int), CAST(:h1 AS int) - 1) AS h(hour)
+        WHERE EXTRACT(ISODOW FROM wm.from_date + g.i) < 6
+    ),
+    ins AS (
+        INSERT INTO slots(start_utc, end_utc, is_booked)
+        SELECT
+            start_local AT TIME ZONE :tz,
+            (start_local + make_interval(mins => CAST(:slot_minutes AS int))) AT TIME ZONE :tz,
+            false
+        FROM grid
+        ON CONFLICT (start_utc) DO NOTHING
+        RETURNING start_utc
+    ),
+    roll AS (
+        INSERT INTO slot_availability_daily(tz, local_date, free_count)
+        SELECT CAST(:tz AS text), (start_utc AT TIME ZONE CAST(:tz AS text))::date, COUNT(*)
+        FROM ins
+        GROUP BY 2
+        ON CONFLICT (tz, local_date) DO UPDATE
+        SET free_count = slot_availability_daily.free_count + EXCLUDED.free_count, updated_at = now()
+    ),
+    mark AS (
+        INSERT INTO slots_watermark(key, generated_until)
+        VALUES (:key, CAST(:last AS date))
+        ON CONFLICT (key) DO UPDATE
+        SET generated_until = GREATEST(slots_watermark.generated_until, EXCLUDED.generated_until)
+    )
+    SELECT (SELECT from_date FROM wm) AS from_date, (SELECT COUNT(*) FROM ins) AS inserted
+    """
+)
+
 
+ENSURE_PARTITIONS_SQL = named_sql("ensure_partitions", "SELECT ensure_slot_partitions(CAST(:from_month AS date), CAST(:to_month AS date))")
+ARCHIVE_PARTITIONS_SQL = named_sql("archive_partitions", "SELECT archive_slot_partitions(CAST(:before_month AS date))")
 
-def _is_weekday(d: date) -> bool:
-    return d.weekday() < 5
 
+def _add_months(d: date, months: int) -> date:
+    y, m = divmod(d.year * 12 + d.month - 1 + months, 12)
+    return date(y, m + 1, 1)
 
-async def ensure_slots_for_range(days_ahead: int):
+
+async def ensure_slots_for_range(days_ahead: int, force: bool = False):
+    """force=True игнорирует водяной знак и перепроверяет весь диапазон (например, /autofill)."""
     if days_ahead <= 0:
         return
     today_local = datetime.now(_tzinfo()).date()
     last_date = today_local + timedelta(days=days_ahead)
 
     async with Session() as s:
-        for d in (today_local + timedelta(days=i) for i in range((last_date - today_local).days + 1)):
-            if not _is_weekday(d):
-                continue
-            for hour in range(WORK_START_HOUR, WORK_END_HOUR):
-                start_local = _localize(datetime(d.year, d.month, d.day, hour, 0, 0))
-                end_local = start_local + timedelta(minutes=SLOT_MINUTES)
-                start_utc = _to_utc(start_local)
-                end_utc = _to_utc(end_local)
-                await s.execute(
-                    text(
-                        """
-                        INSERT INTO slots(start_utc, end_utc, is_booked)
-                        VALUES (:s, :e, false)
-                        ON CONFLICT (start_utc) DO NOTHING
-                        """
-                    ),
-                    {"s": start_utc, "e": end_utc},
-                )
+        # секции должны существовать до вставки: у slots нет default-секции
+        created = (await s.execute(ENSURE_PARTITIONS_SQL, {
+            "from_month": today_local - timedelta(days=1),
+            "to_month": _add_months(last_date, SLOTS_PARTITIONS_AHEAD_MONTHS),
+        })).scalar_one()
+        if created:
+            print(f"AUTO-SLOTS: created {created} slots partition(s)")
+        row = (await s.execute(ENSURE_SLOTS_SQL, {
+            "force": force,
+            "today": today_local,
+            "last": last_date,
+            "key": _slots_watermark_key(),
+            "h0": WORK_START_HOUR,
+            "h1": WORK_END_HOUR,
+            "tz": TZ_NAME,
+            "slot_minutes": SLOT_MINUTES,
+        })).mappings().one()
         await s.commit()
-    print(f"AUTO-SLOTS: ensured next {days_ahead} days.")
+    if row["from_date"] > last_date:
+        print(f"AUTO-SLOTS: up to date through {last_date}.")
+    else:
+        print(f"AUTO-SLOTS: ensured {row['from_date']}..{last_date}, inserted {row['inserted']}.")
+        if row["inserted"]:
+            _cache_invalidate_all()
+
+
+async def archive_slot_partitions():
+    """Секции целиком прошедших месяцев (старше SLOTS_ARCHIVE_AFTER_MONTHS) — в схему slots_archive."""
+    before = _add_months(datetime.now(tz.UTC).date(), -SLOTS_ARCHIVE_AFTER_MONTHS)
+    async with Session() as s:
+        moved = (await s.execute(ARCHIVE_PARTITIONS_SQL, {"before_month": before})).scalar_one()
+        await s.commit()
+    if moved:
+        print(f"AUTO-SLOTS: archived {moved} slots partition(s) older than {before:%Y-%m}")
 
 
 async def auto_slots_loop():
+    # Первый прогон делает on_startup; дальше достаточно досыпать новые дни раз в 6 часов.
+    while True:
+        await asyncio.sleep(6 * 3600)
+        for job in (ensure_slots_for_range(AUTO_SLOTS_DAYS_AHEAD), archive_slot_partitions()):
+            try:
+                await job
+            except Exception as e:
+                print("AUTO-SLOTS loop warn:", repr(e))
+
+
+# ============================================================
+# Availability rollup (slot_availability_daily)
+# ============================================================
+# Живые счётчики по местным дням начиная с сегодняшнего; прошлые дни в rollup не нужны.
+_ROLLUP_LIVE_CTE = """
+    live AS (
+        SELECT (start_utc AT TIME ZONE CAST(:tz AS text))::date AS local_date,
+               COUNT(*) FILTER (WHERE NOT is_booked) AS free
+        FROM slots
+        WHERE start_utc >= :from_utc
+        GROUP BY 1
+    )
+"""
+
+ROLLUP_CHECK_SQL = named_sql("rollup_check",
+    "WITH" + _ROLLUP_LIVE_CTE + """,
+    roll AS (
+        SELECT local_date, free_count
+        FROM slot_availability_daily
+        WHERE tz = CAST(:tz AS text) AND local_date >= CAST(:from_date AS date)
+    )
+    SELECT local_date, COALESCE(live.free, 0) AS live, roll.free_count AS rollup
+    FROM live FULL JOIN roll USING (local_date)
+    WHERE COALESCE(live.free, 0) <> COALESCE(roll.free_count, 0)
+    ORDER BY local_date
+    """
+)
+
+ROLLUP_REBUILD_SQL = named_sql("rollup_rebuild",
+    "WITH" + _ROLLUP_LIVE_CTE + """,
+    gone AS (
+        DELETE FROM slot_availability_daily d
+        WHERE d.tz = CAST(:tz AS text)
+          AND (d.local_date < CAST(:from_date AS date)
+               OR NOT EXISTS (SELECT 1 FROM live WHERE live.local_date = d.local_date))
+        RETURNING 1
+    ),
+    up AS (
+        INSERT INTO slot_availability_daily(tz, local_date, free_count)
+        SELECT CAST(:tz AS text), local_date, free FROM live
+        ON CONFLICT (tz, local_date) DO UPDATE
+        SET free_count = EXCLUDED.free_count, updated_at = now()
+        WHERE slot_availability_daily.free_count <> EXCLUDED.free_count
+        RETURNING 1
+    )
+    SELECT (SELECT COUNT(*) FROM gone) AS deleted, (SELECT COUNT(*) FROM up) AS upserted
+    """
+)
+
+ROLLUP_LOCK_SQL = named_sql("rollup_lock", "LOCK TABLE slot_availability_daily IN SHARE ROW EXCLUSIVE MODE")
+
+
+def _rollup_params() -> Dict[str, Any]:
+    tzinfo_ = _tzinfo()
+    today = datetime.now(tzinfo_).date()
+    return {
+        "tz": TZ_NAME,
+        "from_date": today,
+        "from_utc": datetime.combine(today, datetime.min.time(), tzinfo=tzinfo_),
+    }
+
+
+async def rollup_check(repair: bool = False) -> List[Dict[str, Any]]:
+    """
+    Сверяет rollup со slots одним запросом (один снимок — ложных расхождений нет).
+    Расхождения — это правки slots мимо приложения (ручной SQL); repair=True пересчитывает таблицу.
+    """
+    params = _rollup_params()
+    async with Session() as s:
+        drift = [dict(r) for r in (await s.execute(ROLLUP_CHECK_SQL, params)).mappings().all()]
+        if drift:
+            ROLLUP_DRIFT.inc(len(drift))
+        if drift and repair:
+            # Бронь, генерация и /freeslot правят rollup тем же запросом, что и slots, а их ROW EXCLUSIVE
+            # конфликтует с этой блокировкой: до коммита пересчёта ни одна не пройдёт, а уже начатые
+            # закоммитятся раньше и попадут в его снимок. Иначе абсолютный upsert затёр бы их дельту.
+            await s.execute(ROLLUP_LOCK_SQL)
+            res = (await s.execute(ROLLUP_REBUILD_SQL, params)).mappings().one()
+            await s.commit()
+            print(f"ROLLUP: repaired {len(drift)} day(s) (upserted {res['upserted']}, deleted {res['deleted']})")
+    if drift and repair:
+        _cache_invalidate_all()
+    return drift
+
+
+async def rollup_check_loop():
     while True:
+        await asyncio.sleep(ROLLUP_CHECK_SEC)
         try:
-            await ensure_slots_for_range(AUTO_SLOTS_DAYS_AHEAD)
+            await rollup_check(repair=True)
         except Exception as e:
-            print("AUTO-SLOTS loop warn:", repr(e))
-        await asyncio.sleep(6 * 3600)
+            print("ROLLUP check warn:", repr(e))
 
 
 # ============================================================
@@ -333,68 +1255,619 @@ def get_sheet():
     if _sheet is None:
         if not GSPREAD_SA_JSON or not GSPREAD_SHEET_ID:
             raise RuntimeError("Google Sheets не настроен.")
+        import gspread
+        from google.oauth2.service_account import Credentials as SheetsCreds
+
         sa_info = json.loads(GSPREAD_SA_JSON)
         scopes = ["https://www.googleapis.com/auth/spreadsheets"]
         creds = SheetsCreds.from_service_account_info(sa_info, scopes=scopes)
         gc = gspread.authorize(creds)
         sh = gc.open_by_key(GSPREAD_SHEET_ID)
         ws = sh.sheet1
-        headers = [
-            "timestamp", "tg_id", "tg_username", "name", "phone",
-            "ship_type", "position", "experience", "topic",
-            "slot_start_local", "slot_end_local", "payment_method", "gcal_event_id",
-        ]
         try:
             first = ws.row_values(1)
             if not first:
-                ws.append_rows([headers], value_input_option="RAW", insert_data_option="INSERT_ROWS")
+                ws.append_rows([SHEETS_HEADERS], value_input_option="RAW", insert_data_option="INSERT_ROWS")
+            elif "booking_id" not in first:
+                # таблица от прежней версии: колонку для дедупликации дописываем в заголовок
+                ws.update_cell(1, SHEETS_BOOKING_ID_COL, "booking_id")
         except Exception:
-            ws.append_rows([headers], value_input_option="RAW", insert_data_option="INSERT_ROWS")
+            ws.append_rows([SHEETS_HEADERS], value_input_option="RAW", insert_data_option="INSERT_ROWS")
         _sheet = ws
     return _sheet
 
 
-def append_row_sync(row: list):
+SHEETS_HEADERS = [
+    "timestamp", "tg_id", "tg_username", "name", "phone",
+    "ship_type", "position", "experience", "topic",
+    "slot_start_local", "slot_end_local", "payment_method", "gcal_event_id", "booking_id",
+]
+SHEETS_BOOKING_ID_COL = len(SHEETS_HEADERS)
+
+
+# booking_id строк, уже записанных в таблицу: читаются из неё один раз, дальше пополняются после
+# каждого успешного append. Лок держится на фильтр+append+пополнение: запись, чей вызов executor
+# уже отвалился по таймауту, но ещё идёт в потоке, закончится раньше, чем повтор её проверит.
+_sheets_seen: Optional[set] = None
+_sheets_lock = threading.Lock()
+
+
+def _sheets_seen_locked(ws) -> set:
+    global _sheets_seen
+    if _sheets_seen is None:
+        _sheets_seen = set(ws.col_values(SHEETS_BOOKING_ID_COL)[1:])
+    return _sheets_seen
+
+
+def warm_sheet_sync():
     ws = get_sheet()
+    with _sheets_lock:
+        _sheets_seen_locked(ws)
+
+
+def append_rows_sync(rows: List[list]):
+    """
+    Outbox доставляет at-least-once, а append в Sheets не идемпотентен: строки броней,
+    чей booking_id уже есть в таблице (запись прошлой попытки дошла), пропускаются.
+    """
+    ws = get_sheet()
+    with _sheets_lock:
+        seen = _sheets_seen_locked(ws)
+        fresh, ids = [], set()
+        for row in rows:
+            booking_id = row[SHEETS_BOOKING_ID_COL - 1] if len(row) >= SHEETS_BOOKING_ID_COL else ""
+            if booking_id and (booking_id in seen or booking_id in ids):
+                print(f"SHEETS: booking {booking_id} already in the sheet, skipped")
+                continue
+            if booking_id:
+                ids.add(booking_id)
+            fresh.append(row)
+        if fresh:
+            ws.append_rows(fresh, value_input_option="RAW", insert_data_option="INSERT_ROWS")
+        seen |= ids
+
+
+def _is_sheets_retryable(e: Exception) -> bool:
+    """429 (квота) и 5xx — временные ошибки, остальное сразу отдаём вызывающему."""
+    from gspread.exceptions import APIError
+
+    return isinstance(e, APIError) and getattr(e, "code", None) in (429, 500, 502, 503, 504)
+
+
+class SheetsSink:
+    """
+    Буферизующий писатель в Google Sheets: строки копятся в ограниченной очереди
+    и уходят одним append_rows каждые max_rows строк или flush_ms миллисекунд.
+    append() ждёт фактической записи своей строки, а при полной очереди — места в ней.
+    """
+
+    def __init__(self, max_rows: int, flush_ms: int, queue_max: int, max_retries: int):
+        self.max_rows = max(1, max_rows)
+        self.flush_sec = max(0, flush_ms) / 1000
+        self.max_retries = max(1, max_retries)
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, queue_max))
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def append(self, row: list):
+        self.start()
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((row, fut))
+        await fut
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.flush_sec
+            while len(batch) < self.max_rows:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Tuple[list, asyncio.Future]]):
+        rows = [row for row, _ in batch]
+        delay = 1.0
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                await sheets_executor.run(lambda: append_rows_sync(rows))
+            except Exception as e:
+                if attempt < self.max_retries and _is_sheets_retryable(e):
+                    print(f"WARN: Sheets batch of {len(rows)} retry {attempt}:", repr(e))
+                    await asyncio.sleep(delay + random.uniform(0, delay / 2))
+                    delay = min(delay * 2, 60.0)
+                    continue
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                return
+            print(f"SHEETS: appended {len(rows)} row(s)")
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_result(None)
+            return
+
+
+sheets_sink = SheetsSink(SHEETS_BATCH_MAX_ROWS, SHEETS_FLUSH_MS, SHEETS_QUEUE_MAX, SHEETS_MAX_RETRIES)
+
+
+async def warm_sheets():
+    """Авторизация и проверка заголовка на старте, а не на первой записи."""
+    if not (GSPREAD_SA_JSON and GSPREAD_SHEET_ID):
+        return
     try:
-        ws.append_rows([row], value_input_option="RAW", insert_data_option="INSERT_ROWS")
-    except Exception:
-        time.sleep(2)
-        ws.append_rows([row], value_input_option="RAW", insert_data_option="INSERT_ROWS")
+        await sheets_executor.run(warm_sheet_sync)
+        sheets_sink.start()
+        print("SHEETS: warm OK")
+    except Exception as e:
+        print("WARN: Sheets warm-up failed:", repr(e))
 
 
 # ============================================================
 # Google Calendar
 # ============================================================
-_gcal = None
+GCAL_SCOPE = "https://www.googleapis.com/auth/calendar"
+
+
+class GoogleCalendarError(Exception):
+    def __init__(self, status: int, body: str):
+        super().__init__(f"Calendar API HTTP {status}: {body[:500]}")
+        self.status = status
+        self.body = body
+
+
+class GoogleCalendarClient:
+    """
+    Минимальный асинхронный клиент Calendar API v3 (events insert/patch/delete, freeBusy)
+    поверх одного aiohttp-пула. Токен сервисного аккаунта получается JWT-bearer обменом
+    и обновляется заранее, за GCAL_TOKEN_REFRESH_SKEW_SEC до истечения.
+    """
+
+    def __init__(self, sa_info: Dict[str, Any], calendar_id: str, api_base: str = GCAL_API_BASE, token_uri: str = ""):
+        self.calendar_id = calendar_id
+        self.api_base = api_base.rstrip("/")
+        self.token_uri = token_uri or sa_info.get("token_uri") or "https://oauth2.googleapis.com/token"
+        self._email = sa_info["client_email"]
+        from google.auth import crypt as gauth_crypt
+
+        self._signer = gauth_crypt.RSASigner.from_service_account_info(sa_info)
+        self._token = ""
+        self._token_exp = 0.0
+        self._token_lock = asyncio.Lock()
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _http(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=GCAL_HTTP_POOL, ttl_dns_cache=300, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=GCAL_HTTP_TIMEOUT_SEC),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def _token_fresh(self) -> bool:
+        return bool(self._token) and time.time() < self._token_exp - GCAL_TOKEN_REFRESH_SKEW_SEC
+
+    async def access_token(self) -> str:
+        if self._token_fresh():
+            return self._token
+        async with self._token_lock:
+            if self._token_fresh():
+                return self._token
+            from google.auth import jwt as gauth_jwt
+
+            now = int(time.time())
+            assertion = gauth_jwt.encode(self._signer, {
+                "iss": self._email,
+                "scope": GCAL_SCOPE,
+                "aud": self.token_uri,
+                "iat": now,
+                "exp": now + 3600,
+            }).decode()
+            async with self._http().post(self.token_uri, data={
+                "grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer",
+                "assertion": assertion,
+            }) as r:
+                body = await r.text()
+                if r.status != 200:
+                    raise GoogleCalendarError(r.status, body)
+            tok = json.loads(body)
+            self._token = tok["access_token"]
+            self._token_exp = now + int(tok.get("expires_in", 3600))
+            return self._token
+
+    async def _request(self, method: str, path: str, body: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        for attempt in (1, 2):
+            token = await self.access_token()
+            async with self._http().request(
+                method,
+                self.api_base + path,
+                json=body,
+                headers={"Authorization": f"Bearer {token}"},
+            ) as r:
+                raw = await r.text()
+                if r.status == 401 and attempt == 1:
+                    # Токен отозван/протух раньше срока — берём новый и повторяем один раз.
+                    self._token = ""
+                    continue
+                if r.status >= 400:
+                    raise GoogleCalendarError(r.status, raw)
+                return json.loads(raw) if raw else None
+        return None
+
+    def _events_path(self, event_id: str = "") -> str:
+        path = f"/calendars/{quote(self.calendar_id, safe='')}/events"
+        return path + (f"/{quote(event_id, safe='')}" if event_id else "")
+
+    async def insert_event(self, event: Dict[str, Any]) -> Dict[str, Any]:
+        return await self._request("POST", self._events_path(), event) or {}
+
+    async def patch_event(self, event_id: str, patch: Dict[str, Any]) -> Dict[str, Any]:
+        return await self._request("PATCH", self._events_path(event_id), patch) or {}
+
+    async def delete_event(self, event_id: str):
+        try:
+            await self._request("DELETE", self._events_path(event_id))
+        except GoogleCalendarError as e:
+            if e.status not in (404, 410):
+                raise
+
+    async def freebusy(self, time_min: datetime, time_max: datetime) -> List[Dict[str, str]]:
+        res = await self._request("POST", "/freeBusy", {
+            "timeMin": to_rfc3339(time_min),
+            "timeMax": to_rfc3339(time_max),
+            "items": [{"id": self.calendar_id}],
+        }) or {}
+        return res.get("calendars", {}).get(self.calendar_id, {}).get("busy", [])
+
 
+_gcal: Optional[GoogleCalendarClient] = None
 
-def get_calendar():
+
+def get_calendar() -> GoogleCalendarClient:
     global _gcal
     if _gcal is None:
         if not GCAL_SA_JSON:
             raise RuntimeError("Google Calendar не настроен.")
-        sa_info = json.loads(GCAL_SA_JSON)
-        scopes = ["https://www.googleapis.com/auth/calendar"]
-        creds = CalCreds.from_service_account_info(sa_info, scopes=scopes)
-        _gcal = build("calendar", "v3", credentials=creds, cache_discovery=False)
+        _gcal = GoogleCalendarClient(json.loads(GCAL_SA_JSON), GCAL_CALENDAR_ID, GCAL_API_BASE, GCAL_TOKEN_URI)
     return _gcal
 
 
 def to_rfc3339(dt_utc: datetime) -> str:
-    return dt_utc.replace(tzinfo=tz.UTC).isoformat().replace("+00:00", "Z")
+    return dt_utc.astimezone(tz.UTC).isoformat().replace("+00:00", "Z")
+
+
+async def create_calendar_event(
+    start_utc: datetime, end_utc: datetime, summary: str, description: str, event_id: str = ""
+) -> str:
+    """event_id задаётся заранее, чтобы повторная вставка после сбоя не создавала дубль (409 = уже есть)."""
+    ev = {
+        "summary": summary,
+        "description": description,
+        "start": {"dateTime": to_rfc3339(start_utc), "timeZone": "UTC"},
+        "end": {"dateTime": to_rfc3339(end_utc), "timeZone": "UTC"},
+    }
+    if event_id:
+        ev["id"] = event_id
+    try:
+        created = await get_calendar().insert_event(ev)
+    except GoogleCalendarError as e:
+        if event_id and e.status == 409:
+            return event_id
+        raise
+    return created.get("id", "") or ""
+
+
+async def warm_calendar():
+    """Получаем токен на старте, чтобы первая запись не платила за OAuth-обмен."""
+    if not (GCAL_SA_JSON and GCAL_CALENDAR_ID):
+        return
+    try:
+        await get_calendar().access_token()
+        print("GCAL: token OK")
+    except Exception as e:
+        print("WARN: Calendar warm-up failed:", repr(e))
+
+
+# ============================================================
+# Outbox (побочные эффекты бронирования)
+# ============================================================
+# Задания пишутся в той же транзакции, что и UPDATE slots, и разбираются
+# фоновыми воркерами с повторами и экспоненциальным backoff. Доставка
+# at-least-once: событие календаря идемпотентно за счёт заранее выбранного id.
+
+# Бронирование одним запросом: захват слота, upsert пользователя, строка bookings
+# и задания outbox. Если слот уже занят, claimed пуст и остальные CTE ничего не пишут.
+BOOK_SLOT_SQL = named_sql("book_slot",
+    """
+    WITH claimed AS (
+        UPDATE slots
+        SET is_booked = true
+        WHERE id = :slot_id AND is_booked = false
+          -- окно записи: отсекает устаревшие кнопки и даёт планировщику отбросить чужие секции
+          AND start_utc >= :start_cutoff AND start_utc < :cutoff
+        RETURNING id, start_utc, end_utc
+    ),
+    u AS (
+        INSERT INTO users(tg_id, username)
+        SELECT CAST(:tg_id AS bigint), CAST(:username AS text) FROM claimed
+        ON CONFLICT (tg_id) DO UPDATE SET username = COALESCE(EXCLUDED.username, users.username)
+        RETURNING id
+    ),
+    b AS (
+        INSERT INTO bookings(user_id, slot_id, slot_start_utc, status, payment_method)
+        SELECT u.id, claimed.id, claimed.start_utc, 'requested', CAST(:payment_method AS text)
+        FROM u, claimed
+        RETURNING id
+    ),
+    ob AS (
+        INSERT INTO outbox(kind, payload)
+        SELECT k, CAST(:payload AS jsonb) || jsonb_build_object(
+            'booking_id', b.id,
+            'slot_id', claimed.id,
+            'start_utc', claimed.start_utc,
+            'end_utc', claimed.end_utc
+        )
+        FROM b, claimed, unnest(CAST(:kinds AS text[])) AS k
+    ),
+    roll AS (
+        UPDATE slot_availability_daily d
+        SET free_count = d.free_count - 1, updated_at = now()
+        FROM claimed
+        WHERE d.tz = CAST(:tz AS text)
+          AND d.local_date = (claimed.start_utc AT TIME ZONE CAST(:tz AS text))::date
+    )
+    SELECT claimed.start_utc, claimed.end_utc, b.id AS booking_id
+    FROM claimed, b
+    """
+)
+
+# Освобождение слота админом: снимает бронь, отменяет её строку в bookings и возвращает
+# слот в счётчик дня тем же запросом — как BOOK_SLOT_SQL его оттуда забирает.
+FREE_SLOT_SQL = named_sql("free_slot",
+    """
+    WITH freed AS (
+        UPDATE slots
+        SET is_booked = false
+        WHERE id = :slot_id AND is_booked = true AND start_utc >= now()
+        RETURNING id, start_utc
+    ),
+    cancelled AS (
+        UPDATE bookings b
+        SET status = 'cancelled'
+        FROM freed
+        WHERE b.slot_id = freed.id AND b.status <> 'cancelled'
+        RETURNING b.id
+    ),
+    roll AS (
+        INSERT INTO slot_availability_daily(tz, local_date, free_count)
+        SELECT CAST(:tz AS text), (freed.start_utc AT TIME ZONE CAST(:tz AS text))::date, 1
+        FROM freed
+        ON CONFLICT (tz, local_date) DO UPDATE
+        SET free_count = slot_availability_daily.free_count + 1, updated_at = now()
+    )
+    SELECT freed.start_utc, (SELECT COUNT(*) FROM cancelled) AS cancelled
+    FROM freed
+    """
+)
+
+# Захват пачки: next_attempt_at сдвигается на срок аренды, поэтому задание,
+# захваченное упавшим процессом, само вернётся в очередь после OUTBOX_LEASE_SEC.
+OUTBOX_CLAIM_SQL = named_sql("outbox_claim",
+    """
+    UPDATE outbox
+    SET attempts = attempts + 1,
+        next_attempt_at = now() + make_interval(secs => CAST(:lease AS int))
+    WHERE id IN (
+        SELECT id FROM outbox
+        WHERE status = 'pending' AND next_attempt_at <= now()
+        ORDER BY id
+        LIMIT :n
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, kind, payload, attempts
+    """
+)
+
+# Продление аренды, пока обработчик ещё работает: повторы Sheets/Calendar внутри одной
+# попытки могут идти дольше OUTBOX_LEASE_SEC, и без продления задание забрал бы второй воркер.
+OUTBOX_EXTEND_SQL = named_sql("outbox_extend",
+    """
+    UPDATE outbox
+    SET next_attempt_at = now() + make_interval(secs => CAST(:lease AS int))
+    WHERE id = :id AND status = 'pending'
+    """
+)
+
+_outbox_wakeup = asyncio.Event()
+
+
+def outbox_wakeup():
+    _outbox_wakeup.set()
+
+
+def _booking_outbox_kinds() -> List[str]:
+    kinds = []
+    if GCAL_SA_JSON and GCAL_CALENDAR_ID:
+        kinds.append("gcal_event")
+    if GSPREAD_SA_JSON and GSPREAD_SHEET_ID:
+        kinds.append("sheets_row")
+    if ADMIN_IDS:
+        kinds.append("admin_booking")
+    return kinds
+
+
+def _booking_view(p: Dict[str, Any]) -> Dict[str, Any]:
+    """Payload + локальное время слота для текстов."""
+    start_utc = datetime.fromisoformat(p["start_utc"])
+    end_utc = datetime.fromisoformat(p["end_utc"])
+    return dict(
+        p,
+        start_dt=start_utc,
+        end_dt=end_utc,
+        slot_start_local=human_dt(start_utc),
+        slot_end_local=human_dt(end_utc),
+    )
+
+
+async def _outbox_gcal_event(p: Dict[str, Any]):
+    v = _booking_view(p)
+    tg_u = (v.get("tg_username") or "").lstrip("@")
+    summary = f"Консультация с {v.get('name')} (@{tg_u})"
+    description = (
+        f"Тема: {v.get('topic')}\n"
+        f"Тип судна: {v.get('ship_type')}\n"
+        f"Должность: {v.get('position')}\n"
+        f"Опыт: {v.get('experience')}\n"
+        f"Контакт: {v.get('phone') or '-'}\n"
+        f"Способ оплаты: {v.get('payment_method')}"
+    )
+    await create_calendar_event(v["start_dt"], v["end_dt"], summary, description, v.get("gcal_event_id") or "")
+
+
+async def _outbox_sheets_row(p: Dict[str, Any]):
+    v = _booking_view(p)
+    row_data = [
+        v.get("created_at") or "",
+        str(v.get("tg_id")),
+        v.get("tg_username") or "",
+        v.get("name"),
+        v.get("phone") or "",
+        v.get("ship_type"),
+        v.get("position"),
+        v.get("experience"),
+        v.get("topic"),
+        v.get("slot_start_local"),
+        v.get("slot_end_local"),
+        v.get("payment_method"),
+        v.get("gcal_event_id") or "",
+        str(v.get("booking_id") or ""),
+    ]
+    await sheets_sink.append(row_data)
+
+
+async def _outbox_admin_booking(p: Dict[str, Any]):
+    v = _booking_view(p)
+    await admin_notifier.notify(format_new_booking_admin_message(
+        data=v,
+        tg_user_id=v.get("tg_id"),
+        tg_username_fallback=v.get("tg_username_fallback") or "-",
+        gcal_event_id=v.get("gcal_event_id") or "",
+    ), reliable=True)
+
+
+OUTBOX_HANDLERS: Dict[str, Callable[[Dict[str, Any]], Awaitable[None]]] = {
+    "gcal_event": _outbox_gcal_event,
+    "sheets_row": _outbox_sheets_row,
+    "admin_booking": _outbox_admin_booking,
+}
+
+
+def _outbox_backoff_sec(attempts: int) -> float:
+    return min(OUTBOX_BACKOFF_MAX_SEC, OUTBOX_BACKOFF_BASE_SEC * (2 ** max(attempts - 1, 0)))
+
+
+async def _outbox_keep_lease(job_id: int):
+    while True:
+        await asyncio.sleep(OUTBOX_LEASE_SEC / 3)
+        try:
+            async with Session() as s:
+                await s.execute(OUTBOX_EXTEND_SQL, {"id": job_id, "lease": OUTBOX_LEASE_SEC})
+                await s.commit()
+        except Exception as e:
+            print(f"WARN: outbox #{job_id} lease extension failed:", repr(e))
+
+
+async def _outbox_run(job: Dict[str, Any]):
+    payload = job["payload"]
+    if isinstance(payload, str):
+        payload = json.loads(payload)
+    lease = asyncio.create_task(_outbox_keep_lease(job["id"]))
+    try:
+        handler = OUTBOX_HANDLERS.get(job["kind"])
+        if handler is None:
+            raise RuntimeError(f"unknown outbox kind: {job['kind']}")
+        await handler(payload)
+    except Exception as e:
+        lease.cancel()
+        await _outbox_fail(job, e)
+        return
+    finally:
+        lease.cancel()
+    async with Session() as s:
+        await s.execute(
+            text("UPDATE outbox SET status='done', done_at=now(), last_error=NULL WHERE id=:id"),
+            {"id": job["id"]},
+        )
+        await s.commit()
+
+
+async def _outbox_fail(job: Dict[str, Any], err: Exception):
+    attempts = job["attempts"]
+    final = attempts >= OUTBOX_MAX_ATTEMPTS
+    print(f"WARN: outbox {job['kind']} #{job['id']} attempt {attempts} failed:", repr(err))
+    async with Session() as s:
+        if final:
+            await s.execute(
+                text("UPDATE outbox SET status='failed', last_error=:err WHERE id=:id"),
+                {"id": job["id"], "err": repr(err)},
+            )
+        else:
+            await s.execute(
+                text(
+                    """
+                    UPDATE outbox
+                    SET last_error=:err, next_attempt_at = now() + make_interval(secs => CAST(:delay AS double precision))
+                    WHERE id=:id
+                    """
+                ),
+                {"id": job["id"], "err": repr(err), "delay": _outbox_backoff_sec(attempts)},
+            )
+        await s.commit()
+    if final and job["kind"] != "admin_booking":
+        await notify_admins(
+            f"⚠️ {job['kind']} failed after {attempts} attempts (outbox #{job['id']}): "
+            f"<code>{html.escape(repr(err))}</code>"
+        )
 
 
-def create_calendar_event_sync(start_utc: datetime, end_utc: datetime, summary: str, description: str) -> str:
-    service = get_calendar()
-    ev = {
-        "summary": summary,
-        "description": description,
-        "start": {"dateTime": to_rfc3339(start_utc), "timeZone": "UTC"},
-        "end": {"dateTime": to_rfc3339(end_utc), "timeZone": "UTC"},
-    }
-    created = service.events().insert(calendarId=GCAL_CALENDAR_ID, body=ev).execute()
-    return created.get("id", "") or ""
+async def outbox_worker(worker_no: int):
+    while True:
+        # Сбрасываем флаг до захвата: enqueue+wakeup после этой точки не потеряется.
+        _outbox_wakeup.clear()
+        try:
+            async with Session() as s:
+                jobs = (await s.execute(
+                    OUTBOX_CLAIM_SQL, {"n": OUTBOX_BATCH, "lease": OUTBOX_LEASE_SEC}
+                )).mappings().all()
+                await s.commit()
+        except Exception as e:
+            print(f"OUTBOX worker {worker_no} warn:", repr(e))
+            jobs = []
+        if jobs:
+            results = await asyncio.gather(*(_outbox_run(dict(j)) for j in jobs), return_exceptions=True)
+            errors = [(j, r) for j, r in zip(jobs, results) if isinstance(r, Exception)]
+            for j, r in errors:
+                # учёт done/fail не записался: задачу заберёт повторно кто-то после истечения аренды
+                print(f"OUTBOX worker {worker_no} warn: bookkeeping for #{j['id']} failed:", repr(r))
+            if errors:
+                await asyncio.sleep(1.0)
+            continue
+        try:
+            await asyncio.wait_for(_outbox_wakeup.wait(), OUTBOX_POLL_SEC)
+        except asyncio.TimeoutError:
+            pass
 
 
 # ============================================================
@@ -415,78 +1888,687 @@ class Form(StatesGroup):
 # ============================================================
 # Caching
 # ============================================================
+class TimesCache:
+    """
+    LRU слотов по дням: не больше max_entries дней, просроченное сверх hard TTL
+    выметается периодически, а не только при следующем чтении того же дня.
+    Ведёт примерный объём в байтах (sys.getsizeof списков, словарей и значений).
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max(1, max_entries)
+        self.bytes = 0
+        # day -> (ts записи, слоты, оценка размера)
+        self._items: "OrderedDict[str, Tuple[float, List[Dict[str, Any]], int]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @staticmethod
+    def _sizeof(key: str, data: List[Dict[str, Any]]) -> int:
+        n = sys.getsizeof(key) + sys.getsizeof(data)
+        for x in data:
+            n += sys.getsizeof(x) + sum(sys.getsizeof(v) for v in x.values())
+        return n
+
+    def get(self, key: str) -> Optional[Tuple[float, List[Dict[str, Any]]]]:
+        item = self._items.get(key)
+        if item is None:
+            return None
+        self._items.move_to_end(key)
+        return item[0], item[1]
+
+    def __setitem__(self, key: str, value: Tuple[float, List[Dict[str, Any]]]):
+        self.pop(key, None)
+        ts, data = value
+        size = self._sizeof(key, data)
+        self._items[key] = (ts, data, size)
+        self.bytes += size
+        while len(self._items) > self.max_entries:
+            old, (_, _, old_size) = self._items.popitem(last=False)
+            self.bytes -= old_size
+            CACHE_EVICTIONS.labels("times", "lru").inc()
+
+    def pop(self, key: str, default=None):
+        item = self._items.pop(key, None)
+        if item is None:
+            return default
+        self.bytes -= item[2]
+        return item[0], item[1]
+
+    def clear(self):
+        self._items.clear()
+        self.bytes = 0
+
+    def sweep(self, max_age_sec: float) -> int:
+        now = datetime.utcnow().timestamp()
+        old = [k for k, (ts, _, _) in self._items.items() if now - ts > max_age_sec]
+        for k in old:
+            self.pop(k)
+        CACHE_EVICTIONS.labels("times", "expired").inc(len(old))
+        return len(old)
+
+
 _dates_cache: Dict[str, Tuple[float, List[Dict[str, Any]]]] = {}
-_times_cache: Dict[str, Tuple[float, List[Dict[str, Any]]]] = {}
+_times_cache = TimesCache(TIMES_CACHE_MAX)
+# Счётчик броней на ключ кэша ("dates" или день "YYYY-MM-DD"): загрузка, начатая до брони,
+# не должна перезаписать уже поправленную дельтой запись своим снимком.
+_cache_deltas: Dict[str, int] = {}
+# Растёт при каждом изменении закешированной доступности; отрисованные пикеры привязаны к нему.
+_availability_version = 0
+
+
+def _bump_availability_version():
+    global _availability_version
+    _availability_version += 1
+
+
+def _cache_clear():
+    _dates_cache.clear()
+    _times_cache.clear()
+    _bump_availability_version()
+
+
+def _cache_invalidate_all():
+    """
+    Для изменений, которые дельтой не выразить (генерация слотов): следующий читатель идёт в БД,
+    а индекс в памяти (AVAILABILITY_ENGINE=memory) перечитывается.
+    """
+    _cache_clear()
+    availability_index.invalidate()
 
 
 def _cache_key_dates() -> str:
     return f"{TZ_NAME}:{MIN_DAYS_AHEAD}:{SHOW_DAYS_AHEAD}"
 
 
-def _dates_cache_get() -> Optional[List[Dict[str, Any]]]:
-    item = _dates_cache.get(_cache_key_dates())
+def _cache_lookup(cache: Dict[str, Tuple[float, Any]], name: str, key: str, ttl: int, hard_ttl: int) -> Tuple[Any, bool]:
+    """(data, stale): data=None — промах; stale=True — отдать как есть и обновить в фоне."""
+    item = cache.get(key)
     if not item:
-        return None
+        CACHE_REQUESTS.labels(name, "miss").inc()
+        return None, False
     ts, data = item
-    if (datetime.utcnow().timestamp() - ts) > DATES_CACHE_TTL_SEC:
-        _dates_cache.pop(_cache_key_dates(), None)
-        return None
-    return data
+    age = datetime.utcnow().timestamp() - ts
+    if age > max(hard_ttl, ttl):
+        cache.pop(key, None)
+        CACHE_REQUESTS.labels(name, "expired").inc()
+        return None, False
+    if age > ttl:
+        CACHE_REQUESTS.labels(name, "stale").inc()
+        return data, True
+    CACHE_REQUESTS.labels(name, "hit").inc()
+    return data, False
 
 
-def _dates_cache_set(data: List[Dict[str, Any]]):
-    _dates_cache[_cache_key_dates()] = (datetime.utcnow().timestamp(), data)
+def _dates_cache_get() -> Tuple[Optional[List[Dict[str, Any]]], bool]:
+    return _cache_lookup(_dates_cache, "dates", _cache_key_dates(), DATES_CACHE_TTL_SEC, DATES_CACHE_HARD_TTL_SEC)
 
 
-def _times_cache_get(date_str: str) -> Optional[List[Dict[str, Any]]]:
-    item = _times_cache.get(date_str)
-    if not item:
+def _dates_cache_set(data: List[Dict[str, Any]], deltas_seen: int):
+    if _cache_deltas.get("dates", 0) == deltas_seen:
+        _dates_cache[_cache_key_dates()] = (datetime.utcnow().timestamp(), data)
+        _bump_availability_version()
+
+
+# (действует до unix ts ближайшей местной полуночи, первый день окна, последний день окна)
+_window_days: Tuple[float, date, date] = (0.0, date.min, date.min)
+
+
+def _bookable_window() -> Tuple[date, date]:
+    """Местные дни окна записи (как у _start_cutoff_utc/_cutoff_utc); пересчёт раз в сутки, а не на каждый клик."""
+    global _window_days
+    until, first, last = _window_days
+    if time.time() >= until:
+        tzinfo_ = _tzinfo()
+        now_local = datetime.now(tzinfo_)
+        first = (now_local + timedelta(days=MIN_DAYS_AHEAD)).date()
+        last = (now_local + timedelta(days=MIN_DAYS_AHEAD + SHOW_DAYS_AHEAD)).date()
+        midnight = datetime.combine(now_local.date() + timedelta(days=1), datetime.min.time(), tzinfo=tzinfo_)
+        _window_days = (midnight.timestamp(), first, last)
+    return first, last
+
+
+def _bookable_day(date_str: str) -> Optional[str]:
+    """Канонический ключ дня, если он в окне записи; иначе None — без запроса в БД и без записи в кеш."""
+    if len(date_str) != 10:
         return None
-    ts, data = item
-    if (datetime.utcnow().timestamp() - ts) > TIMES_CACHE_TTL_SEC:
-        _times_cache.pop(date_str, None)
+    try:
+        day = date.fromisoformat(date_str)
+    except ValueError:
         return None
-    return data
+    first, last = _bookable_window()
+    if not (first <= day <= last):
+        return None
+    return day.isoformat()
+
+
+async def cache_sweep_loop():
+    while True:
+        await asyncio.sleep(CACHE_SWEEP_SEC)
+        try:
+            _times_cache.sweep(max(TIMES_CACHE_HARD_TTL_SEC, TIMES_CACHE_TTL_SEC))
+            first_day = _bookable_window()[0].isoformat()
+            for k in [k for k in _cache_deltas if k != "dates" and k < first_day]:
+                del _cache_deltas[k]
+        except Exception as e:
+            print("Cache sweep warn:", repr(e))
+
+
+def _times_cache_get(date_str: str) -> Tuple[Optional[List[Dict[str, Any]]], bool]:
+    return _cache_lookup(_times_cache, "times", date_str, TIMES_CACHE_TTL_SEC, TIMES_CACHE_HARD_TTL_SEC)
+
+
+def _times_cache_set(date_str: str, data: List[Dict[str, Any]], deltas_seen: int):
+    if _cache_deltas.get(date_str, 0) == deltas_seen:
+        _times_cache[date_str] = (datetime.utcnow().timestamp(), data)
+        _bump_availability_version()
+
+
+def _cache_apply_booking(slot_id: int, start_utc: datetime):
+    """
+    Бронь как дельта к кэшам вместо сброса: у дня на один слот меньше, сам слот пропадает из списка,
+    день с нулём слотов исчезает. Списки заменяются новыми — уже выданные читателям не меняются.
+    Возраст записи не обновляется: обычный refresh по TTL сверит её с БД.
+    """
+    availability_index.remove(slot_id, start_utc)
+    day_key = start_utc.astimezone(_tzinfo()).strftime("%Y-%m-%d")
+    day = date.fromisoformat(day_key)
+    for k in ("dates", day_key):
+        _cache_deltas[k] = _cache_deltas.get(k, 0) + 1
+    _bump_availability_version()
+
+    item = _dates_cache.get(_cache_key_dates())
+    if item is not None:
+        ts, days = item
+        patched = []
+        for d in days:
+            if d["local_date"] != day:
+                patched.append(d)
+            elif d["count"] > 1:
+                patched.append({"local_date": day, "count": d["count"] - 1})
+        _dates_cache[_cache_key_dates()] = (ts, patched)
+
+    item = _times_cache.get(day_key)
+    if item is not None:
+        ts, slots = item
+        _times_cache[day_key] = (ts, [x for x in slots if x["id"] != slot_id])
+
+
+def _dates_cache_mark_stale():
+    """Счёт по дням после чужой правки не уточнить без БД: запись станет stale и обновится в фоне."""
+    item = _dates_cache.get(_cache_key_dates())
+    if item is not None:
+        ts, days = item
+        _dates_cache[_cache_key_dates()] = (min(ts, datetime.utcnow().timestamp() - DATES_CACHE_TTL_SEC - 1), days)
+
+
+def _cache_apply_remote(op: str, slot_id: Optional[int], start_utc: Optional[datetime]):
+    """
+    Событие другой реплики или ручной правки. Уменьшать счётчик дня нельзя: наш кеш мог
+    загрузиться уже после их коммита. Поэтому слот убираем из списка (это идемпотентно),
+    день в списке дат помечаем устаревшим, а загрузки, начатые до события, не записываем.
+    """
+    if op not in ("booked", "freed") or start_utc is None:
+        _cache_invalidate_all()
+        return
+    day_key = start_utc.astimezone(_tzinfo()).strftime("%Y-%m-%d")
+    for k in ("dates", day_key):
+        _cache_deltas[k] = _cache_deltas.get(k, 0) + 1
+    _dates_cache_mark_stale()
+    if op == "booked":
+        availability_index.remove(slot_id, start_utc)
+        item = _times_cache.get(day_key)
+        if item is not None:
+            ts, slots = item
+            _times_cache[day_key] = (ts, [x for x in slots if x["id"] != slot_id])
+    else:
+        # конец освободившегося слота в событии не передаётся — индекс перечитает его из БД
+        availability_index.invalidate()
+        _times_cache.pop(day_key, None)
+    _bump_availability_version()
+
+
+class AvailabilityListener:
+    """
+    LISTEN slots_availability на отдельном соединении вне пула. Пока соединения нет,
+    события теряются, поэтому после каждого (пере)подключения кеши сбрасываются целиком.
+    """
+
+    CHANNEL = "slots_availability"
+
+    def __init__(self, keepalive_sec: float = 30.0):
+        self.keepalive_sec = keepalive_sec
+        self.connected = False
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        delay = 1.0
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(
+                    DATABASE_URL.replace("postgresql+asyncpg://", "postgresql://", 1),
+                    ssl=SSL_CTX,
+                    server_settings={"application_name": f"{DB_APPLICATION_NAME}/listen"[:63]},
+                )
+                await conn.add_listener(self.CHANNEL, self._on_notify)
+                self.connected = True
+                _cache_invalidate_all()
+                print(f"AVAILABILITY: listening on {self.CHANNEL} as {DB_APPLICATION_NAME}")
+                delay = 1.0
+                while True:
+                    await asyncio.sleep(self.keepalive_sec)
+                    # полуоткрытый TCP сам не проявится: без запроса мы бы молча перестали получать события
+                    await conn.fetchval("SELECT 1", timeout=10)
+            except Exception as e:
+                print(f"WARN: availability listener down, reconnect in {delay:.0f}s:", repr(e))
+            finally:
+                self.connected = False
+                if conn is not None:
+                    try:
+                        await asyncio.wait_for(conn.close(), 5)
+                    except Exception:
+                        conn.terminate()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+    def _on_notify(self, conn, pid: int, channel: str, payload: str):
+        try:
+            ev = json.loads(payload)
+        except ValueError:
+            return
+        op = str(ev.get("op"))
+        if ev.get("origin") == DB_APPLICATION_NAME:
+            # свою бронь или генерацию слотов этот процесс уже применил к кешам
+            AVAILABILITY_EVENTS.labels(op, "self").inc()
+            return
+        AVAILABILITY_EVENTS.labels(op, "peer").inc()
+        start = ev.get("start")
+        _cache_apply_remote(
+            op,
+            ev.get("id"),
+            datetime.fromtimestamp(float(start), tz.UTC) if start is not None else None,
+        )
+
+
+availability_listener = AvailabilityListener()
+
+
+class SingleFlight:
+    """
+    Склеивает одновременные загрузки одного ключа: запрос в БД делает первый, остальные ждут его future.
+    Загрузка идёт отдельной задачей — отмена одного ожидающего (таймаут апдейта) не рвёт её остальным.
+    """
+
+    def __init__(self, timeout_sec: float):
+        self.timeout_sec = timeout_sec
+        self._inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+
+    async def do(self, key: Tuple[str, str], loader: Callable[[], Awaitable[Any]]) -> Any:
+        return await asyncio.shield(self._start(key, loader, "leader"))
+
+    def refresh(self, key: Tuple[str, str], loader: Callable[[], Awaitable[Any]]):
+        """Фоновое обновление (SWR): запускает загрузку, если её ещё нет, и не ждёт результата."""
+        self._start(key, loader, "refresh")
+
+    def _start(self, key: Tuple[str, str], loader: Callable[[], Awaitable[Any]], role: str) -> asyncio.Future:
+        fut = self._inflight.get(key)
+        if fut is not None:
+            SINGLEFLIGHT_CALLS.labels(key[0], "joined").inc()
+            return fut
+        SINGLEFLIGHT_CALLS.labels(key[0], role).inc()
+        fut = asyncio.ensure_future(asyncio.wait_for(loader(), self.timeout_sec))
+        self._inflight[key] = fut
+        fut.add_done_callback(lambda f: self._done(key, f))
+        return fut
+
+    def _done(self, key: Tuple[str, str], fut: asyncio.Future):
+        if self._inflight.get(key) is fut:
+            del self._inflight[key]
+        if not fut.cancelled() and fut.exception() is not None:
+            # видно и когда ждать было некому (фоновое обновление): старое значение живёт до hard TTL
+            print(f"WARN: availability load {key} failed:", repr(fut.exception()))
+
+    def inflight(self) -> int:
+        return len(self._inflight)
+
+
+availability_flight = SingleFlight(AVAILABILITY_QUERY_TIMEOUT_SEC)
+
+
+INDEX_LOAD_SQL = named_sql("index_load",
+    """
+    SELECT id, start_utc, end_utc
+    FROM slots
+    WHERE is_booked = false
+      AND start_utc >= :lo
+      AND start_utc <  :hi
+    ORDER BY start_utc ASC
+    """
+)
+
 
+class AvailabilityIndex:
+    """
+    Свободные слоты окна записи в памяти (AVAILABILITY_ENGINE=memory): отсортированные по началу
+    массивы epoch-секунд и id, поиск через bisect, счётчики свободных слотов по местным дням.
+    Бронь и чужое "booked" убирают слот на месте; то, что дельтой не выразить (генерация слотов,
+    освобождение, переподключение LISTEN), будит перечитывание. Загружается с запасом за конец
+    окна: пока очередное перечитывание не прошло, окно остаётся внутри загруженного диапазона.
+    """
+
+    def __init__(self, reload_sec: int):
+        self.reload_sec = max(10, reload_sec)
+        self.starts = array("q")
+        self.ends = array("q")
+        self.ids = array("q")
+        self.day_counts: Dict[date, int] = {}
+        self.loaded_from = 0.0
+        self.loaded_until = 0.0
+        self.ready = False
+        # id, убранные во время загрузки: снимок мог быть сделан до их брони
+        self._removed_while_loading: Optional[set] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def invalidate(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def covers(self, start_cutoff: datetime, cutoff: datetime) -> bool:
+        return self.ready and self.loaded_from <= start_cutoff.timestamp() and cutoff.timestamp() <= self.loaded_until
+
+    @staticmethod
+    def _day(epoch: int) -> date:
+        return datetime.fromtimestamp(epoch, _tzinfo()).date()
+
+    @staticmethod
+    def _midnight(day: date) -> float:
+        return datetime.combine(day, datetime.min.time(), tzinfo=_tzinfo()).timestamp()
+
+    def remove(self, slot_id: int, start_utc: datetime) -> bool:
+        if self._removed_while_loading is not None:
+            self._removed_while_loading.add(slot_id)
+        epoch = int(start_utc.timestamp())
+        i = bisect_left(self.starts, epoch)
+        if i == len(self.starts) or self.starts[i] != epoch or self.ids[i] != slot_id:
+            return False
+        del self.starts[i]
+        del self.ends[i]
+        del self.ids[i]
+        day = self._day(epoch)
+        self.day_counts[day] -= 1
+        if not self.day_counts[day]:
+            del self.day_counts[day]
+        return True
+
+    def dates(self, start_cutoff: datetime, cutoff: datetime) -> List[Dict[str, Any]]:
+        """То же, что AVAILABLE_DATES_SQL: внутренние дни из счётчиков, неполные крайние — через bisect."""
+        t0, t1 = start_cutoff.timestamp(), cutoff.timestamp()
+        first_day, last_day = self._day(int(t0)), self._day(int(t1))
+        if first_day == last_day:
+            counts = [(first_day, bisect_left(self.starts, t1) - bisect_left(self.starts, t0))]
+        else:
+            first_end = self._midnight(first_day + timedelta(days=1))
+            last_start = self._midnight(last_day)
+            counts = [(first_day, bisect_left(self.starts, first_end) - bisect_left(self.starts, t0))]
+            counts += sorted((d, n) for d, n in self.day_counts.items() if first_day < d < last_day)
+            counts.append((last_day, bisect_left(self.starts, t1) - bisect_left(self.starts, last_start)))
+        return [{"local_date": d, "count": n} for d, n in counts if n > 0]
+
+    def slots_for_day(self, day: date, start_cutoff: datetime, cutoff: datetime) -> List[Dict[str, Any]]:
+        lo = max(self._midnight(day), start_cutoff.timestamp())
+        hi = min(self._midnight(day + timedelta(days=1)), cutoff.timestamp())
+        return [
+            {
+                "id": self.ids[i],
+                "start_utc": datetime.fromtimestamp(self.starts[i], tz.UTC),
+                "end_utc": datetime.fromtimestamp(self.ends[i], tz.UTC),
+            }
+            for i in range(bisect_left(self.starts, lo), bisect_left(self.starts, hi))
+        ]
+
+    async def reload(self):
+        lo = _start_cutoff_utc()
+        hi = _cutoff_utc() + timedelta(seconds=2 * self.reload_sec)
+        self._removed_while_loading = set()
+        try:
+            async with Session() as s:
+                rows = (await s.execute(INDEX_LOAD_SQL, {"lo": lo, "hi": hi})).all()
+            removed = self._removed_while_loading
+        finally:
+            self._removed_while_loading = None
+        starts, ends, ids = array("q"), array("q"), array("q")
+        day_counts: Dict[date, int] = {}
+        for slot_id, start_utc, end_utc in rows:
+            if slot_id in removed:
+                continue
+            starts.append(int(start_utc.timestamp()))
+            ends.append(int(end_utc.timestamp()))
+            ids.append(slot_id)
+            day = self._day(starts[-1])
+            day_counts[day] = day_counts.get(day, 0) + 1
+        changed = not self.ready or starts != self.starts or ids != self.ids
+        self.starts, self.ends, self.ids, self.day_counts = starts, ends, ids, day_counts
+        self.loaded_from, self.loaded_until = lo.timestamp(), hi.timestamp()
+        self.ready = True
+        if changed:
+            # закешированные списки и пикеры построены по старому индексу
+            _cache_clear()
+            print(f"AVAILABILITY: index holds {len(ids)} free slot(s)")
+
+    async def _run(self):
+        delay = 1.0
+        while True:
+            self._wakeup.clear()
+            try:
+                await self.reload()
+                delay = 1.0
+            except Exception as e:
+                # старый индекс остаётся: брони он видит, а когда окно выйдет за загруженное — читаем из БД
+                print(f"WARN: availability index reload failed, retry in {delay:.0f}s:", repr(e))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30.0)
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.reload_sec)
+            except asyncio.TimeoutError:
+                pass
+
+
+availability_index = AvailabilityIndex(AVAILABILITY_INDEX_RELOAD_SEC)
+
+
+# ============================================================
+# Known users (write-behind для /start)
+# ============================================================
+USERS_UPSERT_SQL = named_sql("users_upsert",
+    """
+    INSERT INTO users(tg_id, username)
+    SELECT * FROM unnest(CAST(:ids AS bigint[]), CAST(:names AS text[]))
+    ON CONFLICT (tg_id) DO UPDATE
+    -- как в BOOK_SLOT_SQL: пользователь без @username не стирает сохранённый
+    SET username = COALESCE(EXCLUDED.username, users.username)
+    WHERE EXCLUDED.username IS NOT NULL AND users.username IS DISTINCT FROM EXCLUDED.username
+    """
+)
+
+
+class KnownUsers:
+    """
+    Ограниченный LRU tg_id -> username уже записанных пользователей. /start для
+    известного пользователя с тем же ником не трогает БД; новые пользователи и
+    смена ника уходят в очередь и пишутся батчем раз в USERS_FLUSH_SEC.
+    """
 
-def _times_cache_set(date_str: str, data: List[Dict[str, Any]]):
-    _times_cache[date_str] = (datetime.utcnow().timestamp(), data)
+    def __init__(self, max_size: int, flush_sec: float, batch: int):
+        self.max_size = max(1, max_size)
+        self.flush_sec = flush_sec
+        self.batch = max(1, batch)
+        self._known: "OrderedDict[int, Optional[str]]" = OrderedDict()
+        self._pending: Dict[int, Optional[str]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def _remember(self, tg_id: int, username: Optional[str]):
+        self._known[tg_id] = username
+        self._known.move_to_end(tg_id)
+        while len(self._known) > self.max_size:
+            self._known.popitem(last=False)
+
+    async def warm(self):
+        async with Session() as s:
+            rows = (await s.execute(
+                text("SELECT tg_id, username FROM users ORDER BY id DESC LIMIT :n"),
+                {"n": self.max_size},
+            )).all()
+        for tg_id, username in reversed(rows):
+            self._remember(tg_id, username)
+        print(f"USERS: warmed {len(rows)} known user(s)")
+
+    def seen(self, tg_id: int, username: Optional[str]):
+        if tg_id in self._known and self._known[tg_id] == username:
+            self._known.move_to_end(tg_id)
+            return
+        self._pending[tg_id] = username
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_sec)
+        await self.flush()
+
+    async def flush(self):
+        while self._pending:
+            chunk = dict(list(self._pending.items())[: self.batch])
+            for tg_id in chunk:
+                self._pending.pop(tg_id, None)
+            try:
+                async with Session() as s:
+                    await s.execute(USERS_UPSERT_SQL, {"ids": list(chunk), "names": list(chunk.values())})
+                    await s.commit()
+            except Exception as e:
+                print("WARN: users flush failed:", repr(e))
+                for tg_id, un in chunk.items():
+                    self._pending.setdefault(tg_id, un)
+                self._flush_task = asyncio.create_task(self._flush_later())
+                return
+            for tg_id, un in chunk.items():
+                self._remember(tg_id, un)
+
+
+known_users = KnownUsers(KNOWN_USERS_MAX, USERS_FLUSH_SEC, USERS_FLUSH_BATCH)
 
 
 # ============================================================
 # Queries
 # ============================================================
-async def fetch_available_dates_counts(session: AsyncSession) -> List[Dict[str, Any]]:
-    cached = _dates_cache_get()
-    if cached is not None:
-        return cached
+# Все значения — bind-параметры: текст запроса постоянный, и asyncpg переиспользует prepared statement.
+# Внутренние дни окна берутся готовыми из slot_availability_daily; первый и последний день
+# окна неполные (отсечка идёт по времени), их считаем по slots — это десяток строк по индексу.
+AVAILABLE_DATES_SQL = named_sql("available_dates",
+    """
+    SELECT local_date, free_count AS cnt
+    FROM slot_availability_daily
+    WHERE tz = CAST(:tz AS text)
+      AND local_date > CAST(:first_day AS date)
+      AND local_date < CAST(:last_day AS date)
+      AND free_count > 0
+    UNION ALL
+    SELECT
+        (start_utc AT TIME ZONE CAST(:tz AS text))::date AS local_date,
+        COUNT(*) AS cnt
+    FROM slots
+    WHERE is_booked = false
+      AND start_utc >= :start_cutoff
+      AND start_utc < :cutoff
+      AND (start_utc < :first_day_end OR start_utc >= :last_day_start)
+    GROUP BY 1
+    ORDER BY 1
+    """
+)
 
-    start_cutoff = _start_cutoff_utc()
-    cutoff = _cutoff_utc()
-    q = text(
-        f"""
-        SELECT
-            (start_utc AT TIME ZONE '{TZ_NAME}')::date AS local_date,
-            COUNT(*) AS cnt
-        FROM slots
-        WHERE is_booked = false
-          AND start_utc >= :start_cutoff
-          AND start_utc < :cutoff
-        GROUP BY 1
-        ORDER BY 1
-        """
-    )
-    rows = (await session.execute(q, {"start_cutoff": start_cutoff, "cutoff": cutoff})).mappings().all()
+FREE_SLOTS_SQL = named_sql("free_slots",
+    """
+    SELECT id, start_utc, end_utc
+    FROM slots
+    WHERE is_booked = false
+      AND start_utc >= :s
+      AND start_utc <  :e
+      AND start_utc >= :start_cutoff
+      AND start_utc <  :cutoff
+    ORDER BY start_utc ASC
+    """
+)
+
+
+async def fetch_available_dates_counts() -> List[Dict[str, Any]]:
+    cached, stale = _dates_cache_get()
+    key = ("dates", _cache_key_dates())
+    if cached is None:
+        return await availability_flight.do(key, _load_available_dates)
+    if stale:
+        availability_flight.refresh(key, _load_available_dates)
+    return cached
+
+
+async def _load_available_dates() -> List[Dict[str, Any]]:
+    deltas_seen = _cache_deltas.get("dates", 0)
+    tzinfo_ = _tzinfo()
+    start_cutoff, cutoff = _start_cutoff_utc(), _cutoff_utc()
+    if availability_index.covers(start_cutoff, cutoff):
+        data = availability_index.dates(start_cutoff, cutoff)
+        _dates_cache_set(data, deltas_seen)
+        return data
+    first_day = start_cutoff.astimezone(tzinfo_).date()
+    last_day = cutoff.astimezone(tzinfo_).date()
+    async with Session() as s:
+        rows = (await s.execute(AVAILABLE_DATES_SQL, {
+            "tz": TZ_NAME,
+            "start_cutoff": start_cutoff,
+            "cutoff": cutoff,
+            "first_day": first_day,
+            "last_day": last_day,
+            "first_day_end": datetime.combine(first_day + timedelta(days=1), datetime.min.time(), tzinfo=tzinfo_),
+            "last_day_start": datetime.combine(last_day, datetime.min.time(), tzinfo=tzinfo_),
+        })).mappings().all()
     data = [{"local_date": r["local_date"], "count": int(r["cnt"])} for r in rows]
-    _dates_cache_set(data)
+    _dates_cache_set(data, deltas_seen)
     return data
 
 
-async def get_free_slots_for_local_date(session: AsyncSession, date_str: str) -> List[dict]:
-    cached = _times_cache_get(date_str)
-    if cached is not None:
-        return cached
-
+async def get_free_slots_for_local_date(date_str: str) -> List[dict]:
+    if _bookable_day(date_str) != date_str:
+        CACHE_REQUESTS.labels("times", "rejected").inc()
+        return []
+    cached, stale = _times_cache_get(date_str)
+    key = ("times", date_str)
+    if cached is None:
+        return await availability_flight.do(key, lambda: _load_free_slots(date_str))
+    if stale:
+        availability_flight.refresh(key, lambda: _load_free_slots(date_str))
+    return cached
+
+
+async def _load_free_slots(date_str: str) -> List[dict]:
+    deltas_seen = _cache_deltas.get(date_str, 0)
+    start_cutoff, cutoff = _start_cutoff_utc(), _cutoff_utc()
+    if availability_index.covers(start_cutoff, cutoff):
+        data = availability_index.slots_for_day(date.fromisoformat(date_str), start_cutoff, cutoff)
+        _times_cache_set(date_str, data, deltas_seen)
+        return data
     y, m, d = map(int, date_str.split("-"))
     tzinfo_ = _tzinfo()
     start_local = datetime(y, m, d, 0, 0, 0, tzinfo=tzinfo_)
@@ -494,24 +2576,13 @@ async def get_free_slots_for_local_date(session: AsyncSession, date_str: str) ->
     start_utc = start_local.astimezone(tz.UTC)
     end_utc = end_local.astimezone(tz.UTC)
 
-    q = text(
-        """
-        SELECT id, start_utc, end_utc
-        FROM slots
-        WHERE is_booked = false
-          AND start_utc >= :s
-          AND start_utc <  :e
-          AND start_utc >= :start_cutoff
-          AND start_utc <  :cutoff
-        ORDER BY start_utc ASC
-        """
-    )
-    rows = (await session.execute(q, {
-        "s": start_utc, "e": end_utc,
-        "start_cutoff": _start_cutoff_utc(), "cutoff": _cutoff_utc(),
-    })).mappings().all()
+    async with Session() as s:
+        rows = (await s.execute(FREE_SLOTS_SQL, {
+            "s": start_utc, "e": end_utc,
+            "start_cutoff": start_cutoff, "cutoff": cutoff,
+        })).mappings().all()
     data = [dict(r) for r in rows]
-    _times_cache_set(date_str, data)
+    _times_cache_set(date_str, data, deltas_seen)
     return data
 
 
@@ -534,7 +2605,7 @@ def build_dates_kb(all_days: List[Dict[str, Any]], page: int) -> Tuple[str, Inli
     rows: List[List[InlineKeyboardButton]] = []
     row: List[InlineKeyboardButton] = []
     for i, dct in enumerate(days, start=1):
-        dt_txt = datetime.strptime(str(dct["local_date"]), "%Y-%m-%d").strftime("%d %b, %a")
+        dt_txt = dct["local_date"].strftime("%d %b, %a")
         row.append(
             InlineKeyboardButton(text=f"📅 {dt_txt} ({dct['count']})", callback_data=f"date:{dct['local_date']}")
         )
@@ -580,6 +2651,43 @@ def build_times_kb(slots: List[Dict[str, Any]], date_str: str) -> Tuple[str, Inl
     return ("Выберите время:", InlineKeyboardMarkup(inline_keyboard=rows))
 
 
+class RenderedPicker(NamedTuple):
+    text: str
+    kb: InlineKeyboardMarkup
+    sig: Optional[str]  # _markup_sig(kb), чтобы safe_edit не сериализовал клавиатуру на каждый клик
+
+
+# (вид, страница или день) -> готовый пикер; действителен, пока не сменилась _availability_version.
+_pickers: Dict[Tuple[str, Any], RenderedPicker] = {}
+_pickers_version = -1
+
+
+def _picker(key: Tuple[str, Any], build: Callable[[], Tuple[str, InlineKeyboardMarkup]]) -> RenderedPicker:
+    global _pickers_version
+    if _pickers_version != _availability_version:
+        _pickers.clear()
+        _pickers_version = _availability_version
+    r = _pickers.get(key)
+    if r is None:
+        CACHE_REQUESTS.labels("picker", "miss").inc()
+        text_msg, kb = build()
+        r = _pickers[key] = RenderedPicker(text_msg, kb, _markup_sig(kb))
+    else:
+        CACHE_REQUESTS.labels("picker", "hit").inc()
+    return r
+
+
+async def dates_picker(page: int) -> RenderedPicker:
+    all_days = await fetch_available_dates_counts()
+    page = max(0, min(page, (len(all_days) - 1) // SLOTS_DATE_PAGE_SIZE))
+    return _picker(("dates", page), lambda: build_dates_kb(all_days, page))
+
+
+async def times_picker(date_str: str) -> RenderedPicker:
+    slots = await get_free_slots_for_local_date(date_str)
+    return _picker(("times", date_str), lambda: build_times_kb(slots, date_str))
+
+
 # ============================================================
 # Guard
 # ============================================================
@@ -612,12 +2720,7 @@ def _form_completed_guard(func):
 # ============================================================
 @dp.message(CommandStart())
 async def on_start(m: Message, state: FSMContext):
-    async with Session() as s:
-        await s.execute(
-            text("INSERT INTO users(tg_id, username) VALUES (:tg,:un) ON CONFLICT (tg_id) DO NOTHING"),
-            {"tg": m.from_user.id, "un": m.from_user.username},
-        )
-        await s.commit()
+    known_users.seen(m.from_user.id, m.from_user.username)
 
     kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="📝 Начать анкету", callback_data="form:start")]])
     await m.answer(WELCOME, reply_markup=kb)
@@ -731,7 +2834,7 @@ async def payment_pick(cq: CallbackQuery, state: FSMContext):
         try:
             data = await state.get_data()
             tg_un = data.get("tg_username") or ("@" + (cq.from_user.username or "")) or "-"
-            await notify_admins(
+            admin_notifier.notify_nowait(
                 f"🌍 <b>Запрос реквизитов (иностранная карта)</b>\n\n"
                 f"Пользователь хочет оплатить иностранной картой — нужно выслать реквизиты.\n"
                 f"👤 <b>Имя:</b> {data.get('name') or '-'}\n"
@@ -743,12 +2846,10 @@ async def payment_pick(cq: CallbackQuery, state: FSMContext):
 
     await state.set_state(Form.waiting_slot)
 
-    async with Session() as s:
-        all_days = await fetch_available_dates_counts(s)
-    slots_text, slots_kb = build_dates_kb(all_days, page=0)
+    picker = await dates_picker(0)
 
     await cq.message.edit_text(payment_text, disable_web_page_preview=True)
-    await cq.message.answer(slots_text, reply_markup=slots_kb)
+    await cq.message.answer(picker.text, reply_markup=picker.kb)
     await cq.answer()
 
 
@@ -759,33 +2860,37 @@ async def cb_dates_paged(cq: CallbackQuery, state: FSMContext):
         page = int(cq.data.split(":")[1])
     except Exception:
         page = 0
-    async with Session() as s:
-        all_days = await fetch_available_dates_counts(s)
-    text_msg, kb = build_dates_kb(all_days, page=page)
-    await safe_edit(cq.message, text_msg, kb)
+    picker = await dates_picker(page)
+    await safe_edit(cq.message, *picker)
     await cq.answer()
 
 
+async def _day_unavailable(cq: CallbackQuery):
+    """Старая кнопка (день вышел из окна записи) или подделанный callback: возвращаем к датам."""
+    await safe_edit(cq.message, *await dates_picker(0))
+    await cq.answer("Эта дата уже недоступна, выберите другую.", show_alert=True)
+
+
 @dp.callback_query(F.data.startswith("date:"))
 @_form_completed_guard
 async def cb_date_pick(cq: CallbackQuery, state: FSMContext):
-    date_str = cq.data.split(":", 1)[1]
-    async with Session() as s:
-        slots = await get_free_slots_for_local_date(s, date_str)
-    text_msg, kb = build_times_kb(slots, date_str)
-    await safe_edit(cq.message, text_msg, kb)
+    date_str = _bookable_day(cq.data.split(":", 1)[1])
+    if date_str is None:
+        await _day_unavailable(cq)
+        return
+    await safe_edit(cq.message, *await times_picker(date_str))
     await cq.answer()
 
 
 @dp.callback_query(F.data.startswith("refresh:"))
 @_form_completed_guard
 async def cb_refresh_times(cq: CallbackQuery, state: FSMContext):
-    date_str = cq.data.split(":", 1)[1]
-    async with Session() as s:
-        _times_cache.pop(date_str, None)
-        slots = await get_free_slots_for_local_date(s, date_str)
-    text_msg, kb = build_times_kb(slots, date_str)
-    await safe_edit(cq.message, text_msg, kb)
+    date_str = _bookable_day(cq.data.split(":", 1)[1])
+    if date_str is None:
+        await _day_unavailable(cq)
+        return
+    _times_cache.pop(date_str, None)
+    await safe_edit(cq.message, *await times_picker(date_str))
     await cq.answer("Обновлено")
 
 
@@ -793,104 +2898,49 @@ async def cb_refresh_times(cq: CallbackQuery, state: FSMContext):
 @_form_completed_guard
 async def choose_slot(cq: CallbackQuery, state: FSMContext):
     slot_id = int(cq.data.split(":", 1)[1])
+    data = await state.get_data()
+    kinds = _booking_outbox_kinds()
+
+    # Calendar / Sheets / уведомление админам — через outbox в той же транзакции.
+    tg_username_fallback = "@" + (cq.from_user.username or "") if cq.from_user.username else "-"
+    payload = {
+        "created_at": datetime.utcnow().isoformat(),
+        "tg_id": cq.from_user.id,
+        "tg_username": data.get("tg_username") or ("@" + (cq.from_user.username or "")),
+        "tg_username_fallback": tg_username_fallback,
+        "name": data.get("name"),
+        "phone": data.get("phone"),
+        "ship_type": data.get("ship_type"),
+        "position": data.get("position"),
+        "experience": data.get("experience"),
+        "topic": data.get("topic"),
+        "payment_method": data.get("payment_method"),
+        "gcal_event_id": uuid.uuid4().hex if "gcal_event" in kinds else "",
+    }
 
     async with Session() as s:
-        upd = await s.execute(
-            text(
-                """
-                UPDATE slots
-                SET is_booked = true
-                WHERE id=:id AND is_booked=false
-                RETURNING start_utc, end_utc
-                """
-            ),
-            {"id": slot_id},
-        )
-        row = upd.first()
+        row = (await s.execute(BOOK_SLOT_SQL, {
+            "slot_id": slot_id,
+            "tg_id": cq.from_user.id,
+            "username": cq.from_user.username,
+            "payment_method": data.get("payment_method"),
+            "payload": json.dumps(payload, ensure_ascii=False),
+            "kinds": kinds,
+            "tz": TZ_NAME,
+            "start_cutoff": _start_cutoff_utc(),
+            "cutoff": _cutoff_utc(),
+        })).first()
         if not row:
+            # индекс в памяти показал слот, которого уже нет (событие чужой брони могло не дойти)
+            availability_index.invalidate()
             await cq.answer("Увы, слот уже занят.", show_alert=True)
             return
-        start_utc, end_utc = row
+        start_utc, end_utc, booking_id = row
         await s.commit()
+    print(f"BOOKING: #{booking_id} slot {slot_id} by {cq.from_user.id}")
+    outbox_wakeup()
 
-    data = await state.update_data(
-        slot_start_local=human_dt(start_utc),
-        slot_end_local=human_dt(end_utc),
-        slot_start_utc=start_utc,
-        slot_end_utc=end_utc,
-    )
-
-    _dates_cache.clear()
-    try:
-        day_key = start_utc.astimezone(_tzinfo()).strftime("%Y-%m-%d")
-        _times_cache.pop(day_key, None)
-    except Exception:
-        pass
-
-    # Calendar
-    gcal_event_id = ""
-    if GCAL_SA_JSON and GCAL_CALENDAR_ID:
-        try:
-            tg_u = (data.get("tg_username") or "").lstrip("@")
-            summary = f"Консультация с {data.get('name')} (@{tg_u})"
-            description = (
-                f"Тема: {data.get('topic')}\n"
-                f"Тип судна: {data.get('ship_type')}\n"
-                f"Должность: {data.get('position')}\n"
-                f"Опыт: {data.get('experience')}\n"
-                f"Контакт: {data.get('phone') or '-'}\n"
-                f"Способ оплаты: {data.get('payment_method')}"
-            )
-            loop = asyncio.get_event_loop()
-            gcal_event_id = await loop.run_in_executor(
-                None, lambda: create_calendar_event_sync(start_utc, end_utc, summary, description)
-            )
-        except Exception as e:
-            print("WARN: Calendar insert failed:", repr(e))
-            await notify_admins(f"⚠️ Calendar insert failed: <code>{repr(e)}</code>")
-
-    # Sheets
-    sheets_ok = False
-    try:
-        if not (GSPREAD_SA_JSON and GSPREAD_SHEET_ID):
-            print("INFO: Sheets not configured; skipping.")
-        else:
-            now = datetime.utcnow().isoformat()
-            row_data = [
-                now,
-                str(cq.from_user.id),
-                data.get("tg_username") or ("@" + (cq.from_user.username or "")),
-                data.get("name"),
-                data.get("phone") or "",
-                data.get("ship_type"),
-                data.get("position"),
-                data.get("experience"),
-                data.get("topic"),
-                data.get("slot_start_local"),
-                data.get("slot_end_local"),
-                data.get("payment_method"),
-                gcal_event_id or "",
-            ]
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(None, lambda: append_row_sync(row_data))
-            sheets_ok = True
-            print("SHEETS: append OK")
-    except Exception as e:
-        print("WARN: Sheets append failed:", repr(e))
-        await notify_admins(f"⚠️ Sheets append failed: <code>{repr(e)}</code>")
-
-    # Уведомить админа
-    try:
-        if sheets_ok:
-            tg_username_fallback = "@" + (cq.from_user.username or "") if cq.from_user.username else "-"
-            await notify_admins(format_new_booking_admin_message(
-                data=data,
-                tg_user_id=cq.from_user.id,
-                tg_username_fallback=tg_username_fallback,
-                gcal_event_id=gcal_event_id,
-            ))
-    except Exception as e:
-        print("WARN: notify_admins failed:", repr(e))
+    _cache_apply_booking(slot_id, start_utc)
 
     await state.clear()
     await safe_edit(
@@ -912,6 +2962,10 @@ async def admin_menu(m: Message):
         "Админ команды:\n"
         "/autofill — сгенерировать слоты\n"
         "/testsheet — тест Google Sheets\n"
+        "/executors — загрузка пулов интеграций\n"
+        "/pool — пул соединений БД\n"
+        "/rollup — сверка счётчиков дней (/rollup fix — пересчитать)\n"
+        "/freeslot &lt;id&gt; — освободить забронированный слот\n"
         "/myid — твой Telegram ID\n"
     )
 
@@ -925,10 +2979,81 @@ async def myid(m: Message):
 async def cmd_autofill(m: Message):
     if m.from_user.id not in ADMIN_IDS:
         return
-    await ensure_slots_for_range(AUTO_SLOTS_DAYS_AHEAD)
+    await ensure_slots_for_range(AUTO_SLOTS_DAYS_AHEAD, force=True)
     await m.answer(f"Готово! Слоты проверены на {AUTO_SLOTS_DAYS_AHEAD} дней вперёд.")
 
 
+@dp.message(Command("executors"))
+async def cmd_executors(m: Message):
+    if m.from_user.id not in ADMIN_IDS:
+        return
+    lines = []
+    for st in (ex.stats() for ex in EXECUTORS.values()):
+        lines.append(
+            f"<b>{st['name']}</b>: active {st['active']}/{st['max_workers']}, "
+            f"queued {st['queued']}/{st['max_queue']}, done {st['completed']}, failed {st['failed']}, "
+            f"rejected {st['rejected']}, timeouts {st['timeouts']}, "
+            f"avg {st['avg_latency_ms']} ms, max {st['max_latency_ms']} ms"
+        )
+    await m.answer("\n".join(lines) or "Пулов нет.")
+
+
+@dp.message(Command("rollup"))
+async def cmd_rollup(m: Message):
+    if m.from_user.id not in ADMIN_IDS:
+        return
+    repair = (m.text or "").split()[1:2] == ["fix"]
+    drift = await rollup_check(repair=repair)
+    if not drift:
+        await m.answer("✅ slot_availability_daily совпадает со slots.")
+        return
+    lines = [f"{d['local_date']}: slots {d['live']}, rollup {d['rollup'] if d['rollup'] is not None else '—'}" for d in drift[:20]]
+    tail = "\n✅ Пересчитано." if repair else "\nПересчитать: /rollup fix"
+    await m.answer(f"⚠️ Расхождений: {len(drift)}\n" + "\n".join(lines) + tail)
+
+
+@dp.message(Command("freeslot"))
+async def cmd_freeslot(m: Message):
+    if m.from_user.id not in ADMIN_IDS:
+        return
+    arg = (m.text or "").split()[1:2]
+    if not arg or not arg[0].isdigit():
+        await m.answer("Формат: /freeslot &lt;id слота&gt;")
+        return
+    async with Session() as s:
+        row = (await s.execute(FREE_SLOT_SQL, {"slot_id": int(arg[0]), "tz": TZ_NAME})).first()
+        await s.commit()
+    if not row:
+        await m.answer("Слот не найден, не забронирован или уже прошёл.")
+        return
+    start_utc, cancelled = row
+    # освобождение дельтой в кешах не выразить; другие реплики узнают о нём из NOTIFY
+    _cache_invalidate_all()
+    print(f"FREESLOT: slot {arg[0]} freed by {m.from_user.id}, cancelled {cancelled} booking(s)")
+    await m.answer(f"✅ Слот {human_dt(start_utc)} снова свободен (отменено броней: {cancelled}).")
+
+
+def _metric_sample(metric, suffix: str) -> float:
+    return next((x.value for x in metric.collect()[0].samples if x.name.endswith(suffix)), 0.0)
+
+
+@dp.message(Command("pool"))
+async def cmd_pool(m: Message):
+    if m.from_user.id not in ADMIN_IDS:
+        return
+    pool = engine.pool
+    count = _metric_sample(POOL_CHECKOUT_WAIT, "_count")
+    total = _metric_sample(POOL_CHECKOUT_WAIT, "_sum")
+    await m.answer(
+        f"<b>DB pool</b>: checked out {pool.checkedout()}, idle {pool.checkedin()}, "
+        f"overflow {max(pool.overflow(), 0)}/{DB_MAX_OVERFLOW}, size {pool.size()}\n"
+        f"checkouts {int(count)}, avg wait {total / count * 1000 if count else 0:.2f} ms, "
+        f"stale replaced {int(_metric_sample(POOL_STALE, '_total'))}\n"
+        f"timeout {DB_POOL_TIMEOUT_SEC:g}s, recycle {DB_POOL_RECYCLE_SEC}s, idle ping {DB_IDLE_PING_SEC:g}s, "
+        f"stmt cache {DB_STATEMENT_CACHE_SIZE}"
+    )
+
+
 @dp.message(Command("testsheet"))
 async def testsheet(m: Message):
     if m.from_user.id not in ADMIN_IDS:
@@ -937,8 +3062,7 @@ async def testsheet(m: Message):
         if not (GSPREAD_SA_JSON and GSPREAD_SHEET_ID):
             await m.answer("⚠️ Sheets не настроен.")
             return
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, lambda: append_row_sync(["test", datetime.utcnow().isoformat()]))
+        await sheets_sink.append(["test", datetime.utcnow().isoformat()])
         await m.answer("✅ Тестовая строка записана.")
     except Exception as e:
         await m.answer(f"⚠️ Ошибка: <code>{repr(e)}</code>")
@@ -947,12 +3071,138 @@ async def testsheet(m: Message):
 # ============================================================
 # Webhook / Server
 # ============================================================
-async def on_startup():
-    await _db_self_test()
-    await _db_init_schema()
-    await ensure_slots_for_range(AUTO_SLOTS_DAYS_AHEAD)
+class OrderedUpdateQueue:
+    """
+    Режим быстрого ack: /webhook только валидирует апдейт и кладёт его в очередь.
+    Апдейты шардируются по чату, у каждого шарда один воркер — сообщения одного
+    чата обрабатываются строго по порядку, разные чаты идут параллельно.
+    Если очередь шарда полна дольше enqueue_timeout, отвечаем 503 и Telegram
+    доставит апдейт повторно.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot_: Bot, workers: int, queue_size: int, enqueue_timeout: float):
+        self.dispatcher = dispatcher
+        self.bot = bot_
+        self.enqueue_timeout = enqueue_timeout
+        self._queues: List[asyncio.Queue] = [asyncio.Queue(maxsize=max(1, queue_size)) for _ in range(max(1, workers))]
+        self._tasks: List[asyncio.Task] = []
+        self._closing = False
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker(q)) for q in self._queues]
+
+    async def close(self, timeout: float):
+        """
+        Остановка: новые апдейты получают 503 (Telegram доставит их другой реплике или после
+        рестарта), а уже подтверждённые 200 дорабатываются — повторно их никто не пришлёт.
+        """
+        self._closing = True
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            print(f"WARN: webhook queue not drained in {timeout:g}s, {self.depth()} update(s) dropped")
+        for t in self._tasks:
+            t.cancel()
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    @staticmethod
+    def _chat_key(update: Update) -> int:
+        ev = update.event
+        chat = getattr(ev, "chat", None) or getattr(getattr(ev, "message", None), "chat", None)
+        if chat is not None:
+            return chat.id
+        user = getattr(ev, "from_user", None)
+        return user.id if user is not None else update.update_id
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self._closing:
+            WEBHOOK_UPDATES.labels("rejected").inc()
+            return web.Response(status=503)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception as e:
+            print("WARN: bad webhook payload:", repr(e))
+            return web.Response(status=400)
+        q = self._queues[self._chat_key(update) % len(self._queues)]
+        item = (time.perf_counter(), update)
+        try:
+            q.put_nowait(item)
+            WEBHOOK_UPDATES.labels("queued").inc()
+        except asyncio.QueueFull:
+            WEBHOOK_UPDATES.labels("saturated").inc()
+            try:
+                await asyncio.wait_for(q.put(item), self.enqueue_timeout)
+            except asyncio.TimeoutError:
+                WEBHOOK_UPDATES.labels("rejected").inc()
+                return web.Response(status=503)
+        return web.json_response({})
+
+    async def _worker(self, q: asyncio.Queue):
+        while True:
+            t_in, update = await q.get()
+            WEBHOOK_QUEUE_WAIT.observe(time.perf_counter() - t_in)
+            try:
+                await self.dispatcher.feed_update(self.bot, update)
+            except Exception as e:
+                print(f"WARN: update {update.update_id} failed:", repr(e))
+            finally:
+                q.task_done()
+
+
+webhook_queue: Optional[OrderedUpdateQueue] = None
+
+
+boot_ready = asyncio.Event()
+
+
+async def _boot_db():
+    delay = 1.0
+    while True:
+        try:
+            await _db_self_test()
+            await run_migrations()
+            # первый старт, смена TZ или правки slots, пока бот не работал
+            await rollup_check(repair=True)
+            return
+        except Exception as e:
+            print(f"WARN: DB boot failed, retry in {delay:.0f}s:", repr(e))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+
+async def _boot_db_chain():
+    """Всё, что зависит от схемы: после неё бот готов, прогревы идут уже в фоне готовности."""
+    await _boot_db()
+    fsm_storage.start()
+    asyncio.create_task(cache_sweep_loop())
+    if AVAILABILITY_LISTEN:
+        availability_listener.start()
+    if AVAILABILITY_ENGINE == "memory":
+        availability_index.start()
+    asyncio.create_task(rollup_check_loop())
+    for i in range(OUTBOX_WORKERS):
+        asyncio.create_task(outbox_worker(i))
+    boot_ready.set()
+    print("READY: DB schema OK, accepting updates")
+
+    for name, res in zip(
+        ("AUTO-SLOTS", "USERS", "ARCHIVE"),
+        await asyncio.gather(
+            ensure_slots_for_range(AUTO_SLOTS_DAYS_AHEAD),
+            known_users.warm(),
+            archive_slot_partitions(),
+            return_exceptions=True,
+        ),
+    ):
+        if isinstance(res, Exception):
+            print(f"WARN: {name} warm-up failed:", repr(res))
     asyncio.create_task(auto_slots_loop())
 
+
+async def _setup_webhook():
     if SKIP_AUTO_WEBHOOK:
         print("INFO: SKIP_AUTO_WEBHOOK=1")
         return
@@ -970,34 +3220,90 @@ async def on_startup():
         await notify_admins(f"⚠️ set_webhook failed: <code>{repr(e)}</code>")
 
 
-async def on_shutdown():
-    try:
-        await bot.delete_webhook()
-    except Exception:
-        pass
+async def on_startup():
+    """Независимые шаги загрузки идут параллельно; сервер к этому моменту уже слушает порт."""
+    t0 = time.perf_counter()
+    results = await asyncio.gather(
+        debug_db_dns(DATABASE_URL),
+        _boot_db_chain(),
+        warm_sheets(),
+        warm_calendar(),
+        _setup_webhook(),
+        return_exceptions=True,
+    )
+    for res in results:
+        if isinstance(res, Exception):
+            print("WARN: startup step failed:", repr(res))
+    print(f"BOOT: finished in {time.perf_counter() - t0:.2f}s")
 
 
-async def main():
-    app = web.Application()
+@web.middleware
+async def _ready_gate(request: web.Request, handler):
+    # Апдейты, пришедшие до готовности БД, ждут её, а не падают на отсутствующей схеме.
+    if request.path == "/webhook" and not boot_ready.is_set():
+        try:
+            await asyncio.wait_for(boot_ready.wait(), WEBHOOK_READY_TIMEOUT_SEC)
+        except asyncio.TimeoutError:
+            return web.Response(status=503, text="starting")
+    return await handler(request)
 
-    SimpleRequestHandler(dispatcher=dp, bot=bot).register(app, path="/webhook")
+
+async def main():
+    global webhook_queue
+    t0 = time.perf_counter()
+    app = web.Application(middlewares=[_ready_gate])
+
+    if WEBHOOK_FAST_ACK:
+        webhook_queue = OrderedUpdateQueue(dp, bot, WEBHOOK_WORKERS, WEBHOOK_QUEUE_PER_WORKER, WEBHOOK_ENQUEUE_TIMEOUT_SEC)
+        webhook_queue.start()
+        app.router.add_post("/webhook", webhook_queue.handle)
+    else:
+        SimpleRequestHandler(dispatcher=dp, bot=bot).register(app, path="/webhook")
     setup_application(app, dp, bot=bot)
 
     async def health_handler(request):
         return web.Response(text="ok")
 
-    app.router.add_get("/", health_handler)
+    async def ready_handler(request):
+        if boot_ready.is_set():
+            return web.Response(text="ready")
+        return web.Response(status=503, text="starting")
 
-    await on_startup()
+    async def metrics_handler(request):
+        return web.Response(body=generate_latest(REGISTRY), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+    app.router.add_get("/", health_handler)
+    app.router.add_get("/ready", ready_handler)
+    app.router.add_get("/metrics", metrics_handler)
 
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, host="0.0.0.0", port=int(os.getenv("PORT", "8080")))
     await site.start()
-    print("Webhook server started")
-
-    while True:
-        await asyncio.sleep(3600)
+    print(f"Webhook server started in {time.perf_counter() - t0:.3f}s")
+
+    boot_task = asyncio.create_task(on_startup())  # ссылка, чтобы задачу не собрал GC
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    # Остановка контейнера: отложенные записи known_users иначе теряются на каждом деплое.
+    print("SHUTDOWN: stopping")
+    if not boot_task.done():
+        boot_task.cancel()
+    if webhook_queue is not None:
+        await webhook_queue.close(WEBHOOK_DRAIN_TIMEOUT_SEC)
+    await runner.cleanup()  # закрывает порт и вызывает dp.shutdown (FSM-хранилище закрывает сам Dispatcher)
+    try:
+        await known_users.flush()
+    except Exception as e:
+        print("WARN: USERS flush on shutdown failed:", repr(e))
+    if _gcal is not None:
+        await _gcal.close()
+    print("SHUTDOWN: done")
 
 
 if __name__ == "__main__":
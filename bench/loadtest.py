@@ -0,0 +1,411 @@
+"""
+Нагрузочный прогон всей воронки записи через /webhook.
+
+Скрипт поднимает stub Bot API (принимает sendMessage / editMessageText /
+answerCallbackQuery и т.д.), при --spawn запускает app.py с TELEGRAM_API_BASE
+на этот stub и гоняет N виртуальных пользователей по шагам:
+
+    /start → form:start → анкета (7 сообщений) → pay:ru → dates:0 → date:<день> → slot:<id>
+
+Задержка шага = от POST апдейта до ответного вызова бота (answerCallbackQuery
+для колбэков, sendMessage для сообщений), поэтому метрика честна и для режима
+быстрого ack. Выбор дат/слотов намеренно сужен (--hot-dates/--hot-slots), чтобы
+воспроизводить гонки в choose_slot.
+
+Пример (локальный Postgres, слоты на весь день):
+
+    WORK_START_HOUR=0 WORK_END_HOUR=24 python bench/loadtest.py --spawn \\
+        --database-url postgresql://postgres@localhost:5432/bot --reset --users 200 --concurrency 50
+"""
+import os
+import sys
+import json
+import time
+import math
+import random
+import asyncio
+import argparse
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiohttp
+from aiohttp import web
+
+BOT_TOKEN = "123456:LOADTEST-stub-token"
+USER_ID_BASE = 7_000_000_000
+FORM_ANSWERS = ["Load", "-", "-", "Bulk carrier", "Chief officer", "5 лет", "Нагрузочный тест"]
+
+
+# ============================================================
+# Stub Bot API
+# ============================================================
+class StubBotApi:
+    """Минимальный Bot API: отвечает успехом и складывает вызовы бота в очередь чата."""
+
+    def __init__(self):
+        self.queues: Dict[int, asyncio.Queue] = {}
+        self.cq_owner: Dict[str, int] = {}
+        self.messages: Dict[Tuple[int, int], Dict[str, Any]] = {}
+        self.next_message_id: Dict[int, int] = {}
+        self.calls: Dict[str, int] = {}
+
+    def queue(self, chat_id: int) -> asyncio.Queue:
+        q = self.queues.get(chat_id)
+        if q is None:
+            q = self.queues[chat_id] = asyncio.Queue()
+        return q
+
+    def _message(self, chat_id: int, message_id: int, params: Dict[str, Any]) -> Dict[str, Any]:
+        msg = self.messages.setdefault((chat_id, message_id), {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": 123456, "is_bot": True, "first_name": "stub"},
+            "text": "",
+        })
+        if "text" in params:
+            msg["text"] = params["text"]
+        if "reply_markup" in params:
+            msg["reply_markup"] = params["reply_markup"]
+        elif "text" in params:
+            msg.pop("reply_markup", None)
+        return msg
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params: Dict[str, Any] = dict(await request.post())
+        if "reply_markup" in params:
+            params["reply_markup"] = json.loads(params["reply_markup"])
+
+        result: Any = True
+        chat_id: Optional[int] = None
+        if method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "stub", "username": "stub_bot"}
+        elif method == "sendMessage":
+            chat_id = int(params["chat_id"])
+            mid = self.next_message_id.get(chat_id, 0) + 1
+            self.next_message_id[chat_id] = mid
+            result = self._message(chat_id, mid, params)
+        elif method in ("editMessageText", "editMessageReplyMarkup"):
+            chat_id = int(params["chat_id"])
+            result = self._message(chat_id, int(params["message_id"]), params)
+        elif method == "answerCallbackQuery":
+            chat_id = self.cq_owner.pop(params.get("callback_query_id", ""), None)
+
+        if chat_id is not None:
+            self.queue(chat_id).put_nowait({"method": method, "params": params, "result": result, "t": time.perf_counter()})
+        return web.json_response({"ok": True, "result": result})
+
+
+# ============================================================
+# Virtual user
+# ============================================================
+class StepTimeout(Exception):
+    pass
+
+
+class VirtualUser:
+    def __init__(self, uid: int, run: "LoadRun"):
+        self.uid = uid
+        self.run = run
+        self.kb_message: Optional[Dict[str, Any]] = None
+        self.user = {"id": uid, "is_bot": False, "first_name": f"Load{uid}", "username": f"load{uid}"}
+
+    def _capture(self, ev: Dict[str, Any]):
+        res = ev["result"]
+        if isinstance(res, dict) and res.get("reply_markup"):
+            self.kb_message = res
+
+    def buttons(self, prefix: str) -> List[str]:
+        if not self.kb_message:
+            return []
+        rows = self.kb_message["reply_markup"].get("inline_keyboard", [])
+        return [b["callback_data"] for row in rows for b in row if str(b.get("callback_data", "")).startswith(prefix)]
+
+    async def expect(self, method: str) -> Dict[str, Any]:
+        q = self.run.stub.queue(self.uid)
+        deadline = time.perf_counter() + self.run.args.step_timeout
+        while True:
+            left = deadline - time.perf_counter()
+            if left <= 0:
+                raise StepTimeout(method)
+            try:
+                ev = await asyncio.wait_for(q.get(), left)
+            except asyncio.TimeoutError:
+                raise StepTimeout(method)
+            self._capture(ev)
+            if ev["method"] == method:
+                return ev
+
+    async def _post(self, update: Dict[str, Any]):
+        async with self.run.http.post(self.run.webhook_url, json=update) as r:
+            await r.read()
+            if r.status != 200:
+                raise RuntimeError(f"webhook HTTP {r.status}")
+
+    async def message(self, step: str, text: str) -> Dict[str, Any]:
+        upd = {
+            "update_id": self.run.next_update_id(),
+            "message": {
+                "message_id": random.randint(1, 2**31),
+                "date": int(time.time()),
+                "chat": {"id": self.uid, "type": "private"},
+                "from": self.user,
+                "text": text,
+            },
+        }
+        if text.startswith("/"):
+            upd["message"]["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        t0 = time.perf_counter()
+        await self._post(upd)
+        ev = await self.expect("sendMessage")
+        self.run.record(step, ev["t"] - t0)
+        return ev
+
+    async def callback(self, step: str, data: str) -> Dict[str, Any]:
+        cq_id = str(self.run.next_update_id())
+        self.run.stub.cq_owner[cq_id] = self.uid
+        msg = self.kb_message or {
+            "message_id": 1, "date": int(time.time()), "chat": {"id": self.uid, "type": "private"}, "text": "",
+        }
+        upd = {
+            "update_id": self.run.next_update_id(),
+            "callback_query": {
+                "id": cq_id,
+                "from": self.user,
+                "chat_instance": str(self.uid),
+                "data": data,
+                "message": msg,
+            },
+        }
+        t0 = time.perf_counter()
+        await self._post(upd)
+        ev = await self.expect("answerCallbackQuery")
+        self.run.record(step, ev["t"] - t0)
+        return ev
+
+    async def funnel(self):
+        args = self.run.args
+        await self.message("start", "/start")
+        await self.callback("form:start", "form:start")
+        for i, answer in enumerate(FORM_ANSWERS):
+            await self.message(f"form:{i + 1}", answer)
+        await self.callback("pay", "pay:ru")
+        await self.callback("dates", "dates:0")
+        days = self.buttons("date:")[: args.hot_dates]
+        if not days:
+            self.run.outcomes["no_dates"] += 1
+            return
+        await self.callback("date", random.choice(days))
+        slots = self.buttons("slot:")[: args.hot_slots]
+        if not slots:
+            self.run.outcomes["no_slots"] += 1
+            return
+        ev = await self.callback("slot", random.choice(slots))
+        if "занят" in (ev["params"].get("text") or ""):
+            self.run.outcomes["race_lost"] += 1
+        else:
+            self.run.outcomes["booked"] += 1
+
+
+# ============================================================
+# Run
+# ============================================================
+class LoadRun:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.stub = StubBotApi()
+        self.webhook_url = f"http://127.0.0.1:{args.port}/webhook"
+        self.http: Optional[aiohttp.ClientSession] = None
+        self.samples: Dict[str, List[float]] = {}
+        self.outcomes = {"booked": 0, "race_lost": 0, "no_dates": 0, "no_slots": 0, "failed": 0}
+        self.failures: Dict[str, int] = {}
+        self._update_id = random.randint(1, 10**6)
+
+    def next_update_id(self) -> int:
+        self._update_id += 1
+        return self._update_id
+
+    def record(self, step: str, dt: float):
+        self.samples.setdefault(step, []).append(dt)
+
+    async def one_user(self, uid: int, sem: asyncio.Semaphore):
+        async with sem:
+            try:
+                await VirtualUser(uid, self).funnel()
+            except Exception as e:
+                self.outcomes["failed"] += 1
+                key = f"{type(e).__name__}: {e}"
+                self.failures[key] = self.failures.get(key, 0) + 1
+
+    async def execute(self) -> Dict[str, Any]:
+        base = self.args.user_id_base or USER_ID_BASE + int(time.time()) % 1_000_000 * 1000
+        sem = asyncio.Semaphore(self.args.concurrency)
+        t0 = time.perf_counter()
+        tasks = []
+        for i in range(self.args.users):
+            tasks.append(asyncio.create_task(self.one_user(base + i, sem)))
+            if self.args.ramp_ms:
+                await asyncio.sleep(self.args.ramp_ms / 1000)
+        await asyncio.gather(*tasks)
+        return self.report(time.perf_counter() - t0)
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        steps = {}
+        for step, xs in self.samples.items():
+            xs = sorted(xs)
+            steps[step] = {
+                "count": len(xs),
+                "p50_ms": round(_pct(xs, 0.50) * 1000, 1),
+                "p95_ms": round(_pct(xs, 0.95) * 1000, 1),
+                "p99_ms": round(_pct(xs, 0.99) * 1000, 1),
+                "max_ms": round(xs[-1] * 1000, 1),
+            }
+        updates = sum(len(xs) for xs in self.samples.values())
+        return {
+            "users": self.args.users,
+            "concurrency": self.args.concurrency,
+            "elapsed_sec": round(elapsed, 2),
+            "updates_per_sec": round(updates / elapsed, 1) if elapsed else 0.0,
+            "funnels_per_sec": round((self.outcomes["booked"] + self.outcomes["race_lost"]) / elapsed, 2) if elapsed else 0.0,
+            "outcomes": self.outcomes,
+            "failures": self.failures,
+            "steps": steps,
+            "bot_api_calls": self.stub.calls,
+        }
+
+
+def _pct(xs: List[float], p: float) -> float:
+    return xs[max(0, math.ceil(p * len(xs)) - 1)]
+
+
+def print_report(rep: Dict[str, Any]):
+    print(f"\nusers={rep['users']} concurrency={rep['concurrency']} elapsed={rep['elapsed_sec']}s "
+          f"updates/s={rep['updates_per_sec']} funnels/s={rep['funnels_per_sec']}")
+    print("outcomes:", ", ".join(f"{k}={v}" for k, v in rep["outcomes"].items()))
+    for k, v in rep["failures"].items():
+        print(f"  failure x{v}: {k}")
+    print(f"\n{'step':<12}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for step, st in rep["steps"].items():
+        print(f"{step:<12}{st['count']:>7}{st['p50_ms']:>10}{st['p95_ms']:>10}{st['p99_ms']:>10}{st['max_ms']:>10}")
+    print("\nBot API calls:", ", ".join(f"{k}={v}" for k, v in sorted(rep["bot_api_calls"].items())))
+
+
+# ============================================================
+# Helpers: app process, DB reset
+# ============================================================
+def _plain_dsn(url: str) -> str:
+    for prefix in ("postgresql+asyncpg://", "postgres://"):
+        if url.startswith(prefix):
+            return "postgresql://" + url[len(prefix):]
+    return url
+
+
+async def reset_db(database_url: str):
+    """Освобождает будущие слоты и удаляет синтетических пользователей прошлых прогонов."""
+    import asyncpg
+
+    conn = await asyncpg.connect(_plain_dsn(database_url))
+    try:
+        freed = await conn.execute("UPDATE slots SET is_booked = false WHERE is_booked AND start_utc >= now()")
+        # слоты освобождены мимо бота — пересчитываем его дневные счётчики
+        await conn.execute(
+            """
+            UPDATE slot_availability_daily d
+            SET free_count = (
+                SELECT COUNT(*) FROM slots
+                WHERE NOT is_booked
+                  AND start_utc >= d.local_date - 1 AND start_utc < d.local_date + 2
+                  AND (start_utc AT TIME ZONE d.tz)::date = d.local_date
+            ), updated_at = now()
+            WHERE d.local_date >= current_date - 1
+            """
+        )
+        users = await conn.execute("DELETE FROM users WHERE tg_id >= $1", USER_ID_BASE)
+        print(f"RESET: {freed}, {users}")
+    finally:
+        await conn.close()
+
+
+async def spawn_app(args: argparse.Namespace) -> asyncio.subprocess.Process:
+    env = dict(os.environ)
+    env.update({
+        "BOT_TOKEN": BOT_TOKEN,
+        "DATABASE_URL": args.database_url,
+        "TELEGRAM_API_BASE": f"http://127.0.0.1:{args.stub_port}",
+        "SKIP_AUTO_WEBHOOK": "1",
+        "PORT": str(args.port),
+        "ADMIN_IDS": env.get("ADMIN_IDS", ""),
+    })
+    app_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+    log = open(args.app_log, "w")
+    proc = await asyncio.create_subprocess_exec(sys.executable, app_path, env=env, stdout=log, stderr=log)
+    async with aiohttp.ClientSession() as http:
+        deadline = time.perf_counter() + 60
+        while time.perf_counter() < deadline:
+            if proc.returncode is not None:
+                raise RuntimeError(f"app.py exited with {proc.returncode}, see {args.app_log}")
+            try:
+                async with http.get(f"http://127.0.0.1:{args.port}/") as r:
+                    if r.status == 200:
+                        return proc
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.3)
+    proc.terminate()
+    raise RuntimeError(f"app.py did not become healthy, see {args.app_log}")
+
+
+async def main(args: argparse.Namespace):
+    run = LoadRun(args)
+    stub_app = web.Application()
+    stub_app.router.add_post("/bot{token}/{method}", run.stub.handle)
+    runner = web.AppRunner(stub_app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.stub_port).start()
+
+    proc = None
+    try:
+        if args.reset:
+            await reset_db(args.database_url)
+        if args.spawn:
+            proc = await spawn_app(args)
+        run.http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency * 2))
+        rep = await run.execute()
+        print_report(rep)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(rep, f, ensure_ascii=False, indent=2)
+    finally:
+        if run.http is not None:
+            await run.http.close()
+        if proc is not None and proc.returncode is None:
+            proc.terminate()
+            await proc.wait()
+        await runner.cleanup()
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(description="Load test for the booking funnel via /webhook")
+    ap.add_argument("--users", type=int, default=50, help="virtual users in total")
+    ap.add_argument("--concurrency", type=int, default=20, help="users in flight at once")
+    ap.add_argument("--ramp-ms", type=int, default=0, help="delay between user starts")
+    ap.add_argument("--hot-dates", type=int, default=1, help="pick a date among the first N offered")
+    ap.add_argument("--hot-slots", type=int, default=2, help="pick a slot among the first N offered")
+    ap.add_argument("--step-timeout", type=float, default=30.0)
+    ap.add_argument("--port", type=int, default=8080, help="app port (/webhook)")
+    ap.add_argument("--stub-port", type=int, default=8081, help="stub Bot API port")
+    ap.add_argument("--spawn", action="store_true", help="start app.py pointed at the stub")
+    ap.add_argument("--app-log", default="loadtest-app.log")
+    ap.add_argument("--database-url", default=os.getenv("DATABASE_URL", ""))
+    ap.add_argument("--reset", action="store_true", help="free future slots and drop synthetic users first")
+    ap.add_argument("--user-id-base", type=int, default=0)
+    ap.add_argument("--json", default="", help="also write the report to this file")
+    args = ap.parse_args(argv)
+    if (args.spawn or args.reset) and not args.database_url:
+        ap.error("--spawn/--reset need --database-url or DATABASE_URL")
+    return args
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
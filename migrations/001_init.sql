@@ -11,6 +11,8 @@ CREATE TABLE IF NOT EXISTS slots (
   is_booked BOOLEAN NOT NULL DEFAULT false
 );
 
+CREATE UNIQUE INDEX IF NOT EXISTS idx_slots_start_utc_unique ON slots(start_utc);
+
 CREATE TABLE IF NOT EXISTS bookings (
   id SERIAL PRIMARY KEY,
   user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
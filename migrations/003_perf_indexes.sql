@@ -0,0 +1,8 @@
+-- Все запросы доступности ищут только свободные слоты в окне по start_utc:
+-- частичный индекс меньше и не требует перестройки при бронировании занятых.
+CREATE INDEX IF NOT EXISTS idx_slots_free_start ON slots(start_utc) WHERE NOT is_booked;
+DROP INDEX IF EXISTS idx_slots_is_booked_start;
+
+-- FK в Postgres не индексируются сами: без них ON DELETE CASCADE и джойны по брони идут seq scan.
+CREATE INDEX IF NOT EXISTS idx_bookings_user_id ON bookings(user_id);
+CREATE INDEX IF NOT EXISTS idx_bookings_slot_id ON bookings(slot_id);
@@ -0,0 +1,68 @@
+-- Изменения доступности рассылаются в канал slots_availability: реплики бота слушают его
+-- и правят свои кеши. origin = application_name соединения, своё событие реплика пропускает.
+
+CREATE OR REPLACE FUNCTION slots_notify_row() RETURNS trigger AS $$
+BEGIN
+  IF NEW.start_utc IS DISTINCT FROM OLD.start_utc OR NEW.end_utc IS DISTINCT FROM OLD.end_utc THEN
+    PERFORM pg_notify('slots_availability', json_build_object(
+      'op', 'reset', 'origin', current_setting('application_name'))::text);
+  ELSIF NEW.is_booked IS DISTINCT FROM OLD.is_booked THEN
+    PERFORM pg_notify('slots_availability', json_build_object(
+      'op', CASE WHEN NEW.is_booked THEN 'booked' ELSE 'freed' END,
+      'id', NEW.id,
+      'start', extract(epoch FROM NEW.start_utc),
+      'origin', current_setting('application_name'))::text);
+  END IF;
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+-- Вставки/удаления пачками (генерация слотов, ручные правки): одно событие на statement,
+-- и только если строки действительно были.
+CREATE OR REPLACE FUNCTION slots_notify_inserted() RETURNS trigger AS $$
+BEGIN
+  IF EXISTS (SELECT 1 FROM new_rows) THEN
+    PERFORM pg_notify('slots_availability', json_build_object(
+      'op', 'reset', 'origin', current_setting('application_name'))::text);
+  END IF;
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION slots_notify_deleted() RETURNS trigger AS $$
+BEGIN
+  IF EXISTS (SELECT 1 FROM old_rows) THEN
+    PERFORM pg_notify('slots_availability', json_build_object(
+      'op', 'reset', 'origin', current_setting('application_name'))::text);
+  END IF;
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION slots_notify_truncated() RETURNS trigger AS $$
+BEGIN
+  PERFORM pg_notify('slots_availability', json_build_object(
+    'op', 'reset', 'origin', current_setting('application_name'))::text);
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS slots_notify_update ON slots;
+CREATE TRIGGER slots_notify_update
+  AFTER UPDATE OF is_booked, start_utc, end_utc ON slots
+  FOR EACH ROW EXECUTE FUNCTION slots_notify_row();
+
+DROP TRIGGER IF EXISTS slots_notify_insert ON slots;
+CREATE TRIGGER slots_notify_insert
+  AFTER INSERT ON slots REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION slots_notify_inserted();
+
+DROP TRIGGER IF EXISTS slots_notify_delete ON slots;
+CREATE TRIGGER slots_notify_delete
+  AFTER DELETE ON slots REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION slots_notify_deleted();
+
+DROP TRIGGER IF EXISTS slots_notify_truncate ON slots;
+CREATE TRIGGER slots_notify_truncate
+  AFTER TRUNCATE ON slots
+  FOR EACH STATEMENT EXECUTE FUNCTION slots_notify_truncated();
@@ -0,0 +1,10 @@
+-- Свободные слоты по местным дням. Ведётся приложением: бронь уменьшает счётчик дня,
+-- генерация слотов увеличивает. Часовой пояс — часть ключа: смена TZ не смешивает счётчики,
+-- строки для нового пояса строит проверка при старте.
+CREATE TABLE IF NOT EXISTS slot_availability_daily (
+  tz TEXT NOT NULL,
+  local_date DATE NOT NULL,
+  free_count INTEGER NOT NULL,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY (tz, local_date)
+);
@@ -0,0 +1,107 @@
+-- slots секционируется по месяцам start_utc: горячие запросы смотрят на несколько дней вперёд,
+-- и их индексы остаются размером в пару секций, а прошлые месяцы уезжают в схему slots_archive.
+
+-- Ссылку bookings -> slots держим без FK: FK на секционированную таблицу не дал бы отсоединять
+-- старые секции. Время слота копируется в бронь, чтобы найти его и в архиве.
+ALTER TABLE bookings DROP CONSTRAINT IF EXISTS bookings_slot_id_fkey;
+ALTER TABLE bookings ADD COLUMN IF NOT EXISTS slot_start_utc TIMESTAMPTZ;
+UPDATE bookings b SET slot_start_utc = s.start_utc FROM slots s WHERE s.id = b.slot_id AND b.slot_start_utc IS NULL;
+
+ALTER TABLE slots RENAME TO slots_unpartitioned;
+-- последовательность id переживает старую таблицу и продолжает нумерацию
+ALTER SEQUENCE slots_id_seq OWNED BY NONE;
+ALTER TABLE slots_unpartitioned DROP CONSTRAINT slots_pkey;
+DROP INDEX IF EXISTS idx_slots_start_utc_unique;
+DROP INDEX IF EXISTS idx_slots_free_start;
+
+CREATE TABLE slots (
+  id INTEGER NOT NULL DEFAULT nextval('slots_id_seq'),
+  start_utc TIMESTAMPTZ NOT NULL,
+  end_utc   TIMESTAMPTZ NOT NULL,
+  is_booked BOOLEAN NOT NULL DEFAULT false,
+  PRIMARY KEY (id, start_utc)
+) PARTITION BY RANGE (start_utc);
+
+ALTER SEQUENCE slots_id_seq OWNED BY slots.id;
+
+CREATE UNIQUE INDEX idx_slots_start_utc_unique ON slots(start_utc);
+CREATE INDEX idx_slots_free_start ON slots(start_utc) WHERE NOT is_booked;
+
+CREATE SCHEMA IF NOT EXISTS slots_archive;
+
+-- Секции slots_pYYYYMM (границы — начало месяца по UTC) с месяца from_month по to_month включительно.
+CREATE OR REPLACE FUNCTION ensure_slot_partitions(from_month date, to_month date) RETURNS integer AS $$
+DECLARE
+  m date := date_trunc('month', from_month)::date;
+  part text;
+  created integer := 0;
+BEGIN
+  PERFORM pg_advisory_xact_lock(hashtext('slot_partitions'));
+  WHILE m <= to_month LOOP
+    part := 'slots_p' || to_char(m, 'YYYYMM');
+    IF to_regclass('public.' || part) IS NULL THEN
+      EXECUTE format(
+        'CREATE TABLE public.%I PARTITION OF slots FOR VALUES FROM (%L) TO (%L)',
+        part,
+        m::timestamp AT TIME ZONE 'UTC',
+        (m + interval '1 month')::timestamp AT TIME ZONE 'UTC'
+      );
+      created := created + 1;
+    END IF;
+    m := (m + interval '1 month')::date;
+  END LOOP;
+  RETURN created;
+END
+$$ LANGUAGE plpgsql;
+
+-- Отсоединяет секции месяцев раньше before_month и переносит их в slots_archive.
+CREATE OR REPLACE FUNCTION archive_slot_partitions(before_month date) RETURNS integer AS $$
+DECLARE
+  part text;
+  moved integer := 0;
+BEGIN
+  PERFORM pg_advisory_xact_lock(hashtext('slot_partitions'));
+  FOR part IN
+    SELECT c.relname
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'public.slots'::regclass
+      AND c.relname ~ '^slots_p[0-9]{6}$'
+      AND to_date(substr(c.relname, 8), 'YYYYMM') < date_trunc('month', before_month)
+    ORDER BY c.relname
+  LOOP
+    EXECUTE format('ALTER TABLE public.slots DETACH PARTITION public.%I', part);
+    EXECUTE format('ALTER TABLE public.%I SET SCHEMA slots_archive', part);
+    moved := moved + 1;
+  END LOOP;
+  RETURN moved;
+END
+$$ LANGUAGE plpgsql;
+
+SELECT ensure_slot_partitions(
+  COALESCE((SELECT min(start_utc AT TIME ZONE 'UTC')::date FROM slots_unpartitioned), current_date),
+  (GREATEST(COALESCE((SELECT max(start_utc AT TIME ZONE 'UTC')::date FROM slots_unpartitioned), current_date), current_date)
+    + interval '3 months')::date
+);
+
+INSERT INTO slots(id, start_utc, end_utc, is_booked)
+SELECT id, start_utc, end_utc, is_booked FROM slots_unpartitioned;
+
+DROP TABLE slots_unpartitioned;
+
+-- Триггеры NOTIFY из 004 ушли вместе со старой таблицей; на секционированной они наследуются секциями.
+CREATE TRIGGER slots_notify_update
+  AFTER UPDATE OF is_booked, start_utc, end_utc ON slots
+  FOR EACH ROW EXECUTE FUNCTION slots_notify_row();
+
+CREATE TRIGGER slots_notify_insert
+  AFTER INSERT ON slots REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION slots_notify_inserted();
+
+CREATE TRIGGER slots_notify_delete
+  AFTER DELETE ON slots REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION slots_notify_deleted();
+
+CREATE TRIGGER slots_notify_truncate
+  AFTER TRUNCATE ON slots
+  FOR EACH STATEMENT EXECUTE FUNCTION slots_notify_truncated();